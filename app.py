@@ -1,28 +1,44 @@
 import os
+import re
 import sqlite3
 import uuid
 import json
-import smtplib
+import hmac
+import base64
+import hashlib
+import atexit
+import logging
+import sys
 import time
+import random
+import threading
+import mimetypes
+import tempfile
+import unicodedata
+from urllib.parse import quote
 from datetime import datetime, timedelta
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file, render_template_string
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file, render_template_string, make_response, g, has_app_context, has_request_context
 from werkzeug.utils import secure_filename
+from markupsafe import Markup
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
-import requests
-import resend
-from dotenv import load_dotenv
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import inch
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
-
-load_dotenv()
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# requests, resend and reportlab are imported inside the functions that use them so
+# that importing the app (and forking gunicorn workers) stays cheap.
+
+if os.path.exists('.env'):
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        print("⚠️ python-dotenv is not installed, .env was not loaded")
 
 app = Flask(__name__)
 
@@ -82,6 +98,90 @@ def save_product_images(files):
     
     return json.dumps(saved_filenames) if saved_filenames else None
 
+# Payment proofs: the raw upload is streamed to a temp file and checked by its magic bytes,
+# then re-encoded as a JPEG no larger than PAYMENT_PROOF_MAX_DIMENSION (which also drops EXIF)
+PAYMENT_PROOF_SIGNATURES = {
+    b'\xff\xd8\xff': 'jpg',
+    b'\x89PNG\r\n\x1a\n': 'png',
+    b'GIF87a': 'gif',
+    b'GIF89a': 'gif',
+}
+
+class PaymentProofError(ValueError):
+    """A payment proof upload that can't be accepted; the message is shown to the buyer"""
+
+def sniff_image_type(header):
+    """Image type from a file's first bytes, or None"""
+    for signature, extension in PAYMENT_PROOF_SIGNATURES.items():
+        if header.startswith(signature):
+            return extension
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def save_payment_proof(file):
+    """Validate and compress an uploaded payment proof into UPLOAD_FOLDER; returns the filename"""
+    max_bytes = app.config['PAYMENT_PROOF_MAX_BYTES']
+    upload_folder = app.config['UPLOAD_FOLDER']
+    
+    # Copy in chunks so a large upload is never held in memory, stopping at the size limit
+    fd, temp_path = tempfile.mkstemp(dir=upload_folder, suffix='.part')
+    try:
+        size = 0
+        with os.fdopen(fd, 'wb') as temp_file:
+            while True:
+                chunk = file.stream.read(64 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise PaymentProofError(f'Payment proof is too large (max {max_bytes // (1024 * 1024)} MB).')
+                temp_file.write(chunk)
+        
+        with open(temp_path, 'rb') as temp_file:
+            extension = sniff_image_type(temp_file.read(16))
+        if not extension:
+            raise PaymentProofError('Payment proof must be a JPG, PNG, WEBP or GIF image.')
+        
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            # Without Pillow the checked original is kept as is
+            filename = f'{uuid.uuid4()}.{extension}'
+            os.replace(temp_path, os.path.join(upload_folder, filename))
+            return filename
+        
+        max_dimension = app.config['PAYMENT_PROOF_MAX_DIMENSION']
+        try:
+            with Image.open(temp_path) as image:
+                if image.width * image.height > 50_000_000:
+                    raise PaymentProofError('Payment proof image dimensions are too large.')
+                image.draft('RGB', (max_dimension, max_dimension))
+                image = ImageOps.exif_transpose(image)
+                if image.mode in ('RGBA', 'LA', 'P'):
+                    # Screenshots with transparency get a white background rather than black
+                    image = image.convert('RGBA')
+                    background = Image.new('RGB', image.size, 'white')
+                    background.paste(image, mask=image.getchannel('A'))
+                    image = background
+                elif image.mode != 'RGB':
+                    image = image.convert('RGB')
+                image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+                
+                filename = f'{uuid.uuid4()}.jpg'
+                image.save(os.path.join(upload_folder, filename), 'JPEG',
+                           quality=app.config['PAYMENT_PROOF_JPEG_QUALITY'], optimize=True, progressive=True)
+        except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+            print(f"⚠️ Unreadable payment proof: {e}")
+            raise PaymentProofError('Payment proof image could not be read. Please upload a screenshot or photo.')
+        
+        print(f"✅ Payment proof {filename}: {size // 1024} KB upload stored as "
+              f"{os.path.getsize(os.path.join(upload_folder, filename)) // 1024} KB")
+        return filename
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
 def delete_product_images(images_json):
     """Delete product images from filesystem"""
     if not images_json:
@@ -149,54 +249,238 @@ def get_product_tags(product_id):
     conn.close()
     return [dict(tag) for tag in tags]
 
-def get_bundles():
-    """Get all bundles with their products"""
-    conn = get_db()
-    bundles = conn.execute('SELECT * FROM bundles ORDER BY name').fetchall()
-    bundle_list = []
+def get_tags_for_products(conn, product_ids):
+    """{product_id: [tag, ...]} for many products, sorted by tag name like get_product_tags"""
+    tags = {product_id: [] for product_id in product_ids}
+    ids = list(tags)
+    for start in range(0, len(ids), 500):
+        batch = ids[start:start + 500]
+        rows = conn.execute(f'''
+            SELECT pt.product_id AS product_id, t.* FROM product_tags pt
+            JOIN tags t ON t.id = pt.tag_id
+            WHERE pt.product_id IN ({','.join('?' * len(batch))})
+            ORDER BY t.name
+        ''', batch).fetchall()
+        for row in rows:
+            tag = dict(row)
+            tags[tag.pop('product_id')].append(tag)
+    return tags
+
+# Card templates for product grids: 'grid' is the full card (home page, landing pages),
+# 'wishlist' the image and body inside the wishlist page's card
+PRODUCT_CARD_TEMPLATES = {'grid': '_product_card.html', 'wishlist': '_wishlist_card.html'}
+
+def render_product_cards(conn, products, variant='grid'):
+    """Card HTML for each product row, in order, rendered at most once per catalog version.
+    
+    The stock count is part of the key because the cards show it and stock changes don't
+    move the catalog version. Tags and images are only looked up for cards not in the cache.
+    """
+    template_name = PRODUCT_CARD_TEMPLATES[variant]
+    catalog_version = get_catalog_version(conn)
+    fragment_cache.sync_version(catalog_version)
     
-    for bundle in bundles:
-        bundle_dict = dict(bundle)
-        # Get products in this bundle
-        products = conn.execute('''
-            SELECT p.* FROM products p
-            JOIN bundle_products bp ON p.id = bp.product_id
-            WHERE bp.bundle_id = ?
-        ''', (bundle['id'],)).fetchall()
-        bundle_dict['products'] = [dict(p) for p in products]
-        bundle_dict['image_urls'] = get_product_images(bundle['images'])
-        bundle_dict['main_image'] = bundle_dict['image_urls'][0] if bundle_dict['image_urls'] else None
-        bundle_list.append(bundle_dict)
+    cards = {}
+    misses = []
+    for product in products:
+        key = fragment_key(template_name, catalog_version, product['id'], product['stock_count'])
+        html = fragment_cache.get(key)
+        record_cache_lookup('fragments', html is not None)
+        if html is None:
+            misses.append((key, product))
+        else:
+            cards[product['id']] = html
+    
+    if misses:
+        template = app.jinja_env.get_template(template_name)
+        tags = get_tags_for_products(conn, [product['id'] for _, product in misses]) if variant == 'grid' else {}
+        for key, product in misses:
+            product_dict = dict(product)
+            product_dict['image_urls'] = get_product_images(product['images'])
+            product_dict['main_image'] = product_dict['image_urls'][0] if product_dict['image_urls'] else None
+            product_dict['tags'] = tags.get(product['id'], [])
+            html = template.render(product=product_dict)
+            fragment_cache.set(key, html)
+            cards[product['id']] = html
+    
+    return [Markup(cards[product['id']]) for product in products]
+
+def render_special_offers(conn, offers):
+    """The home page offers slider, cached like the product cards.
+    
+    Keyed on the offers shown and whether each can be bought, the only part of it that
+    depends on stock.
+    """
+    template_name = '_special_offers.html'
+    catalog_version = get_catalog_version(conn)
+    fragment_cache.sync_version(catalog_version)
+    key = fragment_key(template_name, catalog_version,
+                       tuple((offer['id'], offer['type'] == 'file' or offer['stock_count'] > 0) for offer in offers))
+    html = fragment_cache.get(key)
+    record_cache_lookup('fragments', html is not None)
+    if html is None:
+        special_offers = []
+        for offer in offers:
+            offer_dict = dict(offer)
+            offer_dict['image_urls'] = get_product_images(offer['images'])
+            offer_dict['main_image'] = offer_dict['image_urls'][0] if offer_dict['image_urls'] else None
+            
+            # Use banner image if available, otherwise use main product image
+            if offer['banner_image']:
+                offer_dict['banner_url'] = f"/static/banners/{offer['banner_image']}"
+            else:
+                offer_dict['banner_url'] = offer_dict['main_image']
+            
+            special_offers.append(offer_dict)
+        html = app.jinja_env.get_template(template_name).render(special_offers=special_offers)
+        fragment_cache.set(key, html)
+    return Markup(html)
+
+def get_cache_versions(conn=None):
+    """{name: version} for every row of cache_versions (see init_db), read at most once per request"""
+    if has_request_context() and 'cache_versions' in g:
+        return g.cache_versions
+    
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db()
+    versions = dict(conn.execute('SELECT name, version FROM cache_versions').fetchall())
+    if own_conn:
+        conn.close()
     
-    conn.close()
-    return bundle_list
+    if has_request_context():
+        g.cache_versions = versions
+    return versions
 
-def calculate_bundle_price(bundle_id):
-    """Calculate the total price of a bundle with discount"""
-    conn = get_db()
-    
-    # Get bundle info
-    bundle = conn.execute('SELECT * FROM bundles WHERE id = ?', (bundle_id,)).fetchone()
-    if not bundle:
-        return 0
-    
-    # Get total price of all products in bundle
-    total_price = conn.execute('''
-        SELECT SUM(p.price_dzd) FROM products p
-        JOIN bundle_products bp ON p.id = bp.product_id
-        WHERE bp.bundle_id = ?
-    ''', (bundle_id,)).fetchone()[0] or 0
-    
-    conn.close()
-    
-    # Apply discount
-    if bundle['discount_percentage'] > 0:
+def get_catalog_version(conn=None):
+    """Current catalog version, bumped by triggers whenever the catalog changes"""
+    return get_cache_versions(conn).get('catalog', 0)
+
+def bundle_final_price(bundle, total_price):
+    """Apply a bundle's discount (the percentage wins over a fixed amount) to its products' total"""
+    if (bundle['discount_percentage'] or 0) > 0:
         discount = total_price * (bundle['discount_percentage'] / 100)
         return max(0, total_price - discount)
-    elif bundle['discount_amount'] > 0:
+    elif (bundle['discount_amount'] or 0) > 0:
         return max(0, total_price - bundle['discount_amount'])
     
     return total_price
+
+# Every bundle with its products and prices, newest first, rebuilt when the catalog version moves
+_bundle_cache = {'version': None, 'bundles': []}
+
+def get_bundle_catalog(conn=None):
+    """All bundles with products, original_price, final_price and savings, from the cache"""
+    global _bundle_cache
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db()
+    try:
+        version = get_catalog_version(conn)
+        cached = _bundle_cache
+        if cached['version'] == version:
+            record_cache_lookup('bundles', True)
+            return cached['bundles']
+        record_cache_lookup('bundles', False)
+        
+        bundles = {}
+        for bundle in conn.execute('SELECT * FROM bundles ORDER BY created_at DESC, id DESC').fetchall():
+            bundle_dict = dict(bundle)
+            bundle_dict['products'] = []
+            bundle_dict['image_urls'] = get_product_images(bundle['images'])
+            bundle_dict['main_image'] = bundle_dict['image_urls'][0] if bundle_dict['image_urls'] else None
+            bundles[bundle['id']] = bundle_dict
+        
+        for row in conn.execute('''SELECT bp.bundle_id AS bundle_id, p.* FROM bundle_products bp
+                                    JOIN products p ON p.id = bp.product_id
+                                    ORDER BY bp.id''').fetchall():
+            product = dict(row)
+            bundle = bundles.get(product.pop('bundle_id'))
+            if bundle:
+                bundle['products'].append(product)
+        
+        for bundle in bundles.values():
+            bundle['original_price'] = sum(product['price_dzd'] or 0 for product in bundle['products'])
+            bundle['final_price'] = bundle_final_price(bundle, bundle['original_price'])
+            bundle['savings'] = bundle['original_price'] - bundle['final_price']
+    finally:
+        if own_conn:
+            conn.close()
+    
+    # Replace the whole entry at once so concurrent readers see either the old or the new list
+    _bundle_cache = {'version': version, 'bundles': list(bundles.values())}
+    return _bundle_cache['bundles']
+
+# Active landing pages with their products, by slug. Promo links are what campaigns send
+# thousands of people to at once, so the whole set is loaded in two queries, rebuilt when the
+# catalog or the landing pages change (or after LANDING_PAGE_CACHE_TTL, for stock counts) and
+# warmed at startup by warm_caches(). One thread rebuilds at a time; the others keep serving
+# the previous pages meanwhile rather than all rebuilding when the TTL runs out together.
+_landing_page_cache = {'version': None, 'expires_at': 0, 'pages': {}}
+_landing_page_lock = threading.Lock()
+
+def get_landing_pages(conn):
+    """{slug: (page, products)} for every active landing page, from the cache"""
+    versions = get_cache_versions(conn)
+    version = (versions.get('catalog', 0), versions.get('landing_pages', 0))
+    cached = _landing_page_cache
+    if cached['version'] == version and cached['expires_at'] > time.time():
+        record_cache_lookup('landing_pages', True)
+        return cached['pages']
+    
+    # Serve the stale copy while another thread rebuilds; only a cold cache waits for it
+    if cached['version'] is not None and not _landing_page_lock.acquire(blocking=False):
+        record_cache_lookup('landing_pages', True)
+        return cached['pages']
+    if cached['version'] is None:
+        _landing_page_lock.acquire()
+    try:
+        cached = _landing_page_cache
+        if cached['version'] == version and cached['expires_at'] > time.time():
+            record_cache_lookup('landing_pages', True)
+            return cached['pages']
+        record_cache_lookup('landing_pages', False)
+        return _rebuild_landing_pages(conn, version)
+    finally:
+        _landing_page_lock.release()
+
+def _rebuild_landing_pages(conn, version):
+    global _landing_page_cache
+    pages = {}
+    by_id = {}
+    for page in conn.execute('SELECT * FROM landing_pages WHERE is_active = TRUE').fetchall():
+        entry = (dict(page), [])
+        pages[page['slug']] = entry
+        by_id[page['id']] = entry
+    
+    for row in conn.execute('''SELECT lpp.landing_page_id AS landing_page_id, p.*, c.name as category_name,
+                                      c.icon as category_icon, lpp.display_order
+                               FROM landing_page_products lpp
+                               JOIN landing_pages lp ON lp.id = lpp.landing_page_id
+                               JOIN products p ON p.id = lpp.product_id
+                               LEFT JOIN categories c ON p.category_id = c.id
+                               WHERE lp.is_active = TRUE AND p.is_visible = TRUE
+                               ORDER BY lpp.display_order, lpp.id''').fetchall():
+        product = dict(row)
+        entry = by_id.get(product.pop('landing_page_id'))
+        if entry:
+            entry[1].append(product)
+    
+    # Replace the whole entry at once so concurrent readers see either the old or the new pages
+    _landing_page_cache = {'version': version, 'expires_at': time.time() + app.config['LANDING_PAGE_CACHE_TTL'],
+                           'pages': pages}
+    return pages
+
+def get_bundles():
+    """Get all bundles with their products"""
+    return sorted((dict(bundle) for bundle in get_bundle_catalog()), key=lambda bundle: bundle['name'])
+
+def calculate_bundle_price(bundle_id):
+    """Calculate the total price of a bundle with discount"""
+    for bundle in get_bundle_catalog():
+        if bundle['id'] == bundle_id:
+            return bundle['final_price']
+    return 0
 app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-here')
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['PRODUCTS_FOLDER'] = 'products'
@@ -206,6 +490,79 @@ app.config['BASE_URL'] = os.getenv('BASE_URL', 'https://dzkeyz.onrender.com')
 app.config['CONTACT_EMAIL'] = os.getenv('CONTACT_EMAIL', 'support@yourdomain.com')
 app.config['TELEGRAM_LINK'] = os.getenv('TELEGRAM_LINK', 'https://t.me/StockilyBot')
 
+# File delivery offload: '' serves files from Python, 'x-accel' hands them to nginx
+# (X-Accel-Redirect) and 'x-sendfile' to Apache/lighttpd (X-Sendfile)
+app.config['FILE_OFFLOAD_MODE'] = os.getenv('FILE_OFFLOAD_MODE', '').strip().lower()
+app.config['X_ACCEL_PREFIX'] = os.getenv('X_ACCEL_PREFIX', '/_protected/')
+
+# Resumed (Range) requests allowed per counted download on a token, within
+# DOWNLOAD_RESUME_WINDOW seconds of it; later ones count as a new download
+app.config['DOWNLOAD_RESUMES_PER_DOWNLOAD'] = int(os.getenv('DOWNLOAD_RESUMES_PER_DOWNLOAD', 5))
+app.config['DOWNLOAD_RESUME_WINDOW'] = int(os.getenv('DOWNLOAD_RESUME_WINDOW', 2 * 3600))
+
+# SQLite: seconds a connection waits on a locked database before raising (several workers write concurrently)
+app.config['SQLITE_BUSY_TIMEOUT'] = float(os.getenv('SQLITE_BUSY_TIMEOUT', 15))
+
+# Background maintenance (seconds between runs, 0 disables) and cleanup batch size
+app.config['MAINTENANCE_INTERVAL'] = int(os.getenv('MAINTENANCE_INTERVAL', 3600))
+app.config['TOKEN_CLEANUP_BATCH_SIZE'] = int(os.getenv('TOKEN_CLEANUP_BATCH_SIZE', 500))
+
+# Delivery queue (bulk order actions): each worker sends queued deliveries in a background thread,
+# woken when it queues some and otherwise checking every DELIVERY_POLL_INTERVAL seconds (0 disables
+# the thread; run `flask process-deliveries` instead). Failed sends are retried up to DELIVERY_MAX_ATTEMPTS.
+app.config['DELIVERY_POLL_INTERVAL'] = int(os.getenv('DELIVERY_POLL_INTERVAL', 30))
+app.config['DELIVERY_MAX_ATTEMPTS'] = int(os.getenv('DELIVERY_MAX_ATTEMPTS', 3))
+
+# Structured request logs: fraction of requests logged (0 disables); errors and requests
+# slower than REQUEST_LOG_SLOW_MS are always logged
+app.config['REQUEST_LOG_SAMPLE_RATE'] = float(os.getenv('REQUEST_LOG_SAMPLE_RATE', 1.0))
+app.config['REQUEST_LOG_SLOW_MS'] = float(os.getenv('REQUEST_LOG_SLOW_MS', 1000))
+
+# SQL statements slower than this are logged and listed on /admin/slow-queries (0 disables)
+app.config['SLOW_QUERY_MS'] = float(os.getenv('SLOW_QUERY_MS', 50))
+
+# /metrics: per-worker snapshots are written to METRICS_DIR at most every
+# METRICS_FLUSH_INTERVAL seconds. Scraping needs METRICS_TOKEN or an admin session;
+# METRICS_ALLOW_LOCALHOST also lets loopback in, which is only safe when no reverse proxy
+# forwards public traffic from 127.0.0.1.
+app.config['METRICS_DIR'] = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'dzkeyz-metrics'))
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN', '')
+app.config['METRICS_ALLOW_LOCALHOST'] = os.getenv('METRICS_ALLOW_LOCALHOST', 'false').lower() == 'true'
+
+# Rendered product cards and the special offers slider are cached per worker, up to this many bytes
+app.config['FRAGMENT_CACHE_MAX_BYTES'] = int(os.getenv('FRAGMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+# Storefront pages (/, /product/<id>, /promo/<slug>) are cached per worker for anonymous
+# visitors for PAGE_CACHE_TTL seconds (0 disables), or until the catalog or branding changes.
+# PAGE_CACHE_EXCLUDE lists endpoints to always render fresh, e.g. "landing_page,index".
+app.config['PAGE_CACHE_TTL'] = int(os.getenv('PAGE_CACHE_TTL', 60))
+app.config['PAGE_CACHE_MAX_BYTES'] = int(os.getenv('PAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+app.config['PAGE_CACHE_EXCLUDE'] = {name.strip() for name in os.getenv('PAGE_CACHE_EXCLUDE', '').split(',') if name.strip()}
+
+# Profiling: admins can profile one request with ?_profile=1 or an "X-Profile: 1" header.
+# PROFILE_SAMPLE_RATE profiles that fraction of all requests and keeps the ones slower than
+# PROFILE_SLOW_MS. Only the newest PROFILE_KEEP profiles are kept in PROFILE_DIR.
+app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR', 'profiles')
+app.config['PROFILE_SAMPLE_RATE'] = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_SLOW_MS'] = float(os.getenv('PROFILE_SLOW_MS', 1000))
+app.config['PROFILE_KEEP'] = int(os.getenv('PROFILE_KEEP', 50))
+
+# Reviews shown per page on the product page; more load on demand
+app.config['REVIEWS_PAGE_SIZE'] = int(os.getenv('REVIEWS_PAGE_SIZE', 10))
+
+# Landing pages are served from memory; this bounds how stale their stock counts can get (seconds)
+app.config['LANDING_PAGE_CACHE_TTL'] = int(os.getenv('LANDING_PAGE_CACHE_TTL', 60))
+
+# Payment proof uploads: largest accepted file, and the longest side / JPEG quality they are stored at
+app.config['PAYMENT_PROOF_MAX_BYTES'] = int(os.getenv('PAYMENT_PROOF_MAX_BYTES', 10 * 1024 * 1024))
+app.config['PAYMENT_PROOF_MAX_DIMENSION'] = int(os.getenv('PAYMENT_PROOF_MAX_DIMENSION', 1600))
+app.config['PAYMENT_PROOF_JPEG_QUALITY'] = int(os.getenv('PAYMENT_PROOF_JPEG_QUALITY', 80))
+
+# Products per page on the home page grid and /api/catalog (which accepts ?limit= up to the max)
+app.config['CATALOG_PAGE_SIZE'] = int(os.getenv('CATALOG_PAGE_SIZE', 24))
+app.config['CATALOG_MAX_PAGE_SIZE'] = int(os.getenv('CATALOG_MAX_PAGE_SIZE', 60))
+
 # Ensure directories exist
 os.makedirs('uploads', exist_ok=True)
 os.makedirs('products', exist_ok=True)
@@ -216,9 +573,16 @@ os.makedirs('receipts', exist_ok=True)
 
 # Database setup
 def init_db():
-    conn = sqlite3.connect('store.db')
+    conn = sqlite3.connect('store.db', timeout=app.config['SQLITE_BUSY_TIMEOUT'])
     c = conn.cursor()
     
+    # WAL lets readers run alongside a writer, which matters once there are several workers.
+    # The journal mode is stored in the database file, so this only has to happen once.
+    try:
+        c.execute('PRAGMA journal_mode=WAL')
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ Could not enable WAL mode: {e}")
+    
     # Categories table
     c.execute('''CREATE TABLE IF NOT EXISTS categories (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -380,6 +744,13 @@ def init_db():
         # Column already exists
         pass
     
+    # Add idempotency_key column if it doesn't exist (one per checkout form, see submit_order)
+    try:
+        c.execute('ALTER TABLE orders ADD COLUMN idempotency_key TEXT')
+    except sqlite3.OperationalError:
+        # Column already exists
+        pass
+    
     # Audit log table
     c.execute('''CREATE TABLE IF NOT EXISTS audit_log (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -443,6 +814,82 @@ def init_db():
         FOREIGN KEY (product_id) REFERENCES products (id)
     )''')
     
+    # Add resume_count column if it doesn't exist (Range requests that continue a counted download)
+    try:
+        c.execute('ALTER TABLE download_tokens ADD COLUMN resume_count INTEGER DEFAULT 0')
+    except sqlite3.OperationalError:
+        # Column already exists
+        pass
+    
+    # Deliveries and rejection notices waiting to be sent, see process_delivery_queue
+    c.execute('''CREATE TABLE IF NOT EXISTS delivery_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id INTEGER NOT NULL,
+        action TEXT NOT NULL CHECK(action IN ('deliver', 'notify_rejection')),
+        status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending', 'processing', 'done', 'failed')),
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT,
+        claimed_at REAL,
+        sent_channels TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        processed_at TIMESTAMP,
+        FOREIGN KEY (order_id) REFERENCES orders (id) ON DELETE CASCADE
+    )''')
+    
+    # Add sent_channels column if it doesn't exist (channels a retried delivery must not send again)
+    try:
+        c.execute('ALTER TABLE delivery_queue ADD COLUMN sent_channels TEXT')
+    except sqlite3.OperationalError:
+        # Column already exists
+        pass
+    
+    # Maintenance task bookkeeping (shared by all worker processes)
+    c.execute('''CREATE TABLE IF NOT EXISTS maintenance_runs (
+        task TEXT PRIMARY KEY,
+        last_run_at REAL DEFAULT 0,
+        last_result TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    
+    # Slow SQL statements, aggregated per normalized statement shape
+    c.execute('''CREATE TABLE IF NOT EXISTS slow_queries (
+        shape_id TEXT PRIMARY KEY,
+        statement TEXT NOT NULL,
+        calls INTEGER DEFAULT 0,
+        total_ms REAL DEFAULT 0,
+        max_ms REAL DEFAULT 0,
+        last_params TEXT,
+        last_endpoint TEXT,
+        query_plan TEXT,
+        full_scan BOOLEAN DEFAULT FALSE,
+        first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    
+    # Precomputed "related products" per product (rebuild_related_products)
+    c.execute('''CREATE TABLE IF NOT EXISTS related_products (
+        product_id INTEGER NOT NULL,
+        related_id INTEGER NOT NULL,
+        score REAL NOT NULL,
+        reason TEXT NOT NULL CHECK (reason IN ('co_purchase', 'similar')),
+        PRIMARY KEY (product_id, related_id)
+    )''')
+    
+    # cProfile runs of single requests; the pstats dumps live in PROFILE_DIR
+    c.execute('''CREATE TABLE IF NOT EXISTS request_profiles (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        method TEXT,
+        path TEXT,
+        endpoint TEXT,
+        status INTEGER,
+        duration_ms REAL,
+        db_queries INTEGER,
+        db_ms REAL,
+        trigger TEXT NOT NULL CHECK (trigger IN ('admin', 'sampled')),
+        filename TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+    
     # Landing pages table for custom promo pages
     c.execute('''CREATE TABLE IF NOT EXISTS landing_pages (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -485,6 +932,23 @@ def init_db():
         FOREIGN KEY (product_id) REFERENCES products (id),
         UNIQUE(user_id, product_id)
     )''')
+    
+    # Per-product review count, rating sum and star histogram, kept up to date by submit_review
+    summary_exists = c.execute('''SELECT 1 FROM sqlite_master 
+                                  WHERE type = 'table' AND name = 'product_rating_summary' ''').fetchone()
+    c.execute('''CREATE TABLE IF NOT EXISTS product_rating_summary (
+        product_id INTEGER PRIMARY KEY,
+        review_count INTEGER NOT NULL DEFAULT 0,
+        rating_sum INTEGER NOT NULL DEFAULT 0,
+        stars_1 INTEGER NOT NULL DEFAULT 0,
+        stars_2 INTEGER NOT NULL DEFAULT 0,
+        stars_3 INTEGER NOT NULL DEFAULT 0,
+        stars_4 INTEGER NOT NULL DEFAULT 0,
+        stars_5 INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (product_id) REFERENCES products (id)
+    )''')
+    if not summary_exists:
+        rebuild_rating_summaries(conn)
 
     # Wishlists table
     c.execute('''CREATE TABLE IF NOT EXISTS wishlists (
@@ -541,6 +1005,42 @@ def init_db():
         # Column already exists
         pass
     
+    # Catalog version: bumped by triggers whenever products (other than their stock counts),
+    # bundles, categories or tags change, so per-worker caches of catalog data know to reload
+    c.execute('''CREATE TABLE IF NOT EXISTS cache_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )''')
+    c.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('catalog', 0)")
+    c.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('branding', 0)")
+    c.execute("INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('landing_pages', 0)")
+    catalog_product_columns = ('name, description, price_dzd, type, images, category_id, is_visible, is_featured, '
+                               'special_offer, offer_label, banner_image, offer_order')
+    catalog_triggers = {
+        'products': ['INSERT', 'DELETE', f'UPDATE OF {catalog_product_columns}'],
+        'bundles': ['INSERT', 'DELETE', 'UPDATE'],
+        'bundle_products': ['INSERT', 'DELETE', 'UPDATE'],
+        'categories': ['INSERT', 'DELETE', 'UPDATE'],
+        'tags': ['INSERT', 'DELETE', 'UPDATE'],
+        'product_tags': ['INSERT', 'DELETE', 'UPDATE'],
+    }
+    for table, events in catalog_triggers.items():
+        for event in events:
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.split()[0].lower()}_catalog_version 
+                          AFTER {event} ON {table} 
+                          BEGIN UPDATE cache_versions SET version = version + 1 WHERE name = 'catalog'; END''')
+    # Branding version: store_settings are shown on every page, see cached_page
+    for event in ('INSERT', 'DELETE', 'UPDATE'):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_store_settings_{event.lower()}_branding_version 
+                      AFTER {event} ON store_settings 
+                      BEGIN UPDATE cache_versions SET version = version + 1 WHERE name = 'branding'; END''')
+    # Landing pages version: see get_landing_page
+    for table in ('landing_pages', 'landing_page_products'):
+        for event in ('INSERT', 'DELETE', 'UPDATE'):
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_landing_pages_version 
+                          AFTER {event} ON {table} 
+                          BEGIN UPDATE cache_versions SET version = version + 1 WHERE name = 'landing_pages'; END''')
+    
     # Create default admin if not exists
     c.execute('SELECT COUNT(*) FROM admin')
     if c.fetchone()[0] == 0:
@@ -551,35 +1051,755 @@ def init_db():
     try:
         # Optimize homepage products query
         c.execute('CREATE INDEX IF NOT EXISTS idx_products_visible_featured ON products(is_visible, is_featured, created_at)')
+        # Catalog API sorts, with and without a category filter (the rowid, p.id, ends every
+        # index, so keyset cursors on (..., id) are range scans)
+        c.execute('CREATE INDEX IF NOT EXISTS idx_products_visible_category_featured ON products(is_visible, category_id, is_featured, created_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_products_visible_created ON products(is_visible, created_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_products_visible_price ON products(is_visible, price_dzd)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_products_visible_category_price ON products(is_visible, category_id, price_dzd)')
 
         # Optimize order lookups
         c.execute('CREATE INDEX IF NOT EXISTS idx_orders_product_id ON orders(product_id)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders(user_id)')
+        # (user_id, product_id, status) also covers lookups by user_id alone, so it replaces idx_orders_user_id
+        c.execute('DROP INDEX IF EXISTS idx_orders_user_id')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_product ON orders(user_id, product_id, status)')
 
         # Optimize product stock checks
         c.execute('CREATE INDEX IF NOT EXISTS idx_product_keys_status ON product_keys(product_id, is_used)')
 
-        # Optimize reviews lookup
-        c.execute('CREATE INDEX IF NOT EXISTS idx_reviews_product ON reviews(product_id)')
+        # Wishlist page: a user's items, newest first
+        c.execute('CREATE INDEX IF NOT EXISTS idx_wishlists_user_created ON wishlists(user_id, created_at)')
+
+        # Keys delivered for an order (my_orders, redelivery)
+        c.execute('CREATE INDEX IF NOT EXISTS idx_product_keys_order ON product_keys(used_by_order_id)')
+
+        # Review pages: newest first per product (replaces idx_reviews_product)
+        c.execute('DROP INDEX IF EXISTS idx_reviews_product')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_reviews_product_created ON reviews(product_id, created_at, id)')
+
+        # Optimize download token expiry cleanup and per-order token lookups
+        c.execute('CREATE INDEX IF NOT EXISTS idx_download_tokens_expires ON download_tokens(expires_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_download_tokens_order ON download_tokens(order_id, created_at)')
+
+        # Top related products of a product
+        c.execute('CREATE INDEX IF NOT EXISTS idx_related_products_score ON related_products(product_id, score)')
+
+        # Next deliveries to send
+        c.execute('CREATE INDEX IF NOT EXISTS idx_delivery_queue_status ON delivery_queue(status, id)')
+
+        # A retried checkout form finds the order it already created
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_idempotency_key ON orders(idempotency_key) WHERE idempotency_key IS NOT NULL')
 
         print("✅ Database indexes created/verified")
     except Exception as e:
         print(f"⚠️ Error creating indexes: {e}")
+    
+    # A payment's transaction ID can back only one live order (a rejected order frees it for a
+    # new attempt). Kept apart from the indexes above: existing duplicates make it fail, and
+    # submit_order still checks before inserting.
+    try:
+        c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_payment_transaction ON orders(payment_method, transaction_id)
+                     WHERE transaction_id IS NOT NULL AND status != 'rejected' AND payment_method IN ('baridimob', 'ccp')''')
+    except sqlite3.IntegrityError as e:
+        print(f"⚠️ Duplicate transaction IDs in orders, not enforcing uniqueness: {e}")
 
     conn.commit()
     conn.close()
 
-# Initialize database when app starts
-try:
+# Query instrumentation: connections from get_db() count and time every statement
+# into the request context, and the request log reports the totals.
+def record_query(sql, parameters, elapsed, fetch=False):
+    """Account for a statement (or, with fetch=True, for reading its rows)"""
+    if has_app_context():
+        if not fetch:
+            g.db_queries = g.get('db_queries', 0) + 1
+        g.db_time = g.get('db_time', 0.0) + elapsed
+    threshold = app.config['SLOW_QUERY_MS']
+    if threshold > 0 and elapsed * 1000 >= threshold:
+        note_slow_query(sql, parameters, elapsed)
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._statement = (sql, parameters, time.perf_counter() - started)
+            record_query(*self._statement)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._statement = None
+            record_query(sql, None, time.perf_counter() - started)
+
+    def fetchall(self):
+        # Most of the work of a large SELECT happens while stepping through its rows
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            statement = getattr(self, '_statement', None)
+            if statement:
+                sql, parameters, exec_elapsed = statement
+                fetch_elapsed = time.perf_counter() - started
+                if has_app_context():
+                    g.db_time = g.get('db_time', 0.0) + fetch_elapsed
+                threshold = app.config['SLOW_QUERY_MS']
+                # Only report here if execute() alone wasn't already slow
+                if threshold > 0 and exec_elapsed * 1000 < threshold <= (exec_elapsed + fetch_elapsed) * 1000:
+                    note_slow_query(sql, parameters, exec_elapsed + fetch_elapsed)
+
+class InstrumentedConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def json_logger(name):
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+request_logger = json_logger('dzkeyz.requests')
+slow_query_logger = json_logger('dzkeyz.slow_queries')
+
+# Slow queries are logged straight away but written to the slow_queries table after the
+# response (flush_slow_queries), never from inside a transaction that may hold the lock.
+_pending_slow_queries = []
+_slow_query_lock = threading.Lock()
+MAX_PENDING_SLOW_QUERIES = 200
+
+def normalize_sql(sql):
+    """Statement shape: literals become ?, IN lists collapse, whitespace is squeezed"""
+    shape = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    shape = re.sub(r'\b\d+(?:\.\d+)?\b', '?', shape)
+    shape = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(?, ...)', shape)
+    return ' '.join(shape.split())
+
+def redact_params(parameters):
+    """Keep the type and length of bound values but never the values themselves"""
+    def redact(value):
+        if value is None:
+            return None
+        if isinstance(value, (str, bytes)):
+            return f'<{type(value).__name__}:{len(value)}>'
+        return f'<{type(value).__name__}>'
+    if parameters is None:
+        return None
+    if isinstance(parameters, dict):
+        return {key: redact(value) for key, value in parameters.items()}
+    return [redact(value) for value in parameters]
+
+def note_slow_query(sql, parameters, elapsed):
+    shape = normalize_sql(sql)
+    endpoint = request.endpoint if has_request_context() else None
+    slow_query_logger.warning(json.dumps({
+        'event': 'slow_query',
+        'ts': round(time.time(), 3),
+        'ms': round(elapsed * 1000, 2),
+        'statement': shape,
+        'params': redact_params(parameters),
+        'endpoint': endpoint,
+        'pid': os.getpid(),
+    }))
+    with _slow_query_lock:
+        if len(_pending_slow_queries) < MAX_PENDING_SLOW_QUERIES:
+            _pending_slow_queries.append((shape, sql, parameters, elapsed, endpoint))
+
+def is_full_scan(plan_detail):
+    """A SCAN step that doesn't use an index reads the whole table"""
+    return (plan_detail.startswith('SCAN ') and 'USING' not in plan_detail
+            and 'CONSTANT ROW' not in plan_detail and 'SUBQUERY' not in plan_detail.upper())
+
+def explain_query_plan(conn, sql, parameters):
+    if not sql.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT', 'REPLACE')):
+        return None, False
+    try:
+        rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, parameters or ()).fetchall()
+    except sqlite3.Error as e:
+        return f'unavailable: {e}', False
+    details = [row[3] for row in rows]
+    return '\n'.join(details), any(is_full_scan(detail) for detail in details)
+
+def flush_slow_queries():
+    """Aggregate pending slow statements into slow_queries, running EXPLAIN QUERY PLAN
+    the first time a statement shape is seen"""
+    with _slow_query_lock:
+        if not _pending_slow_queries:
+            return
+        pending = _pending_slow_queries[:]
+        del _pending_slow_queries[:]
+    
+    try:
+        # A plain connection, so these statements aren't timed themselves
+        conn = sqlite3.connect('store.db', timeout=1)
+        for shape, sql, parameters, elapsed, endpoint in pending:
+            shape_id = hashlib.sha1(shape.encode()).hexdigest()[:16]
+            known = conn.execute('SELECT 1 FROM slow_queries WHERE shape_id = ?', (shape_id,)).fetchone()
+            if not known:
+                plan, full_scan = explain_query_plan(conn, sql, parameters)
+                if full_scan:
+                    print(f"⚠️ Slow query does a full table scan: {shape[:200]}")
+                conn.execute('''INSERT OR IGNORE INTO slow_queries (shape_id, statement, query_plan, full_scan) 
+                               VALUES (?, ?, ?, ?)''', (shape_id, shape, plan, full_scan))
+            ms = elapsed * 1000
+            conn.execute('''UPDATE slow_queries SET calls = calls + 1, total_ms = total_ms + ?, 
+                           max_ms = MAX(max_ms, ?), last_params = ?, last_endpoint = ?, last_seen = CURRENT_TIMESTAMP 
+                           WHERE shape_id = ?''',
+                        (ms, ms, json.dumps(redact_params(parameters)), endpoint, shape_id))
+        conn.commit()
+        conn.close()
+    except sqlite3.Error as e:
+        print(f"⚠️ Could not record slow queries: {e}")
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.db_queries = 0
+    g.db_time = 0.0
+
+@app.after_request
+def log_request(response):
+    started = g.get('request_started')
+    if started is None or request.endpoint == 'static':
+        return response
+    
+    duration_ms = (time.perf_counter() - started) * 1000
+    sample_rate = app.config['REQUEST_LOG_SAMPLE_RATE']
+    if not (response.status_code >= 500
+            or duration_ms >= app.config['REQUEST_LOG_SLOW_MS']
+            or (sample_rate > 0 and random.random() < sample_rate)):
+        return response
+    
+    request_logger.info(json.dumps({
+        'event': 'request',
+        'ts': round(time.time(), 3),
+        'method': request.method,
+        'route': request.url_rule.rule if request.url_rule else None,
+        'endpoint': request.endpoint,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round(duration_ms, 2),
+        'db_queries': g.get('db_queries', 0),
+        'db_ms': round(g.get('db_time', 0.0) * 1000, 2),
+        'pid': os.getpid(),
+    }))
+    return response
+
+# Metrics: each worker keeps counters and histograms in memory and writes a snapshot
+# file to METRICS_DIR; /metrics adds up the snapshots of every gunicorn worker.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = {
+    'dzkeyz_http_requests_total': ('counter', 'HTTP requests by endpoint, method and status'),
+    'dzkeyz_http_request_duration_seconds': ('histogram', 'HTTP request latency by endpoint'),
+    'dzkeyz_requests_in_flight': ('gauge', 'Requests being handled (worker thread pool usage)'),
+    'dzkeyz_db_connections_total': ('counter', 'SQLite connections opened'),
+    'dzkeyz_external_call_duration_seconds': ('histogram', 'Latency of calls to Resend and Telegram'),
+    'dzkeyz_orders_total': ('counter', 'Orders by lifecycle event'),
+    'dzkeyz_emails_total': ('counter', 'Emails by result'),
+    'dzkeyz_telegram_retries_total': ('counter', 'Telegram sends retried with another method or chat id'),
+    'dzkeyz_cache_requests_total': ('counter', 'Cache lookups by cache and result'),
+}
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.last_flush = 0.0
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add_gauge(self, name, amount, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+            # Stored per bucket (last one is +Inf) and made cumulative when rendered
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    hist['buckets'][i] += 1
+                    break
+            else:
+                hist['buckets'][-1] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'pid': self.pid,
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'gauges': [[name, list(labels), value] for (name, labels), value in self.gauges.items()],
+                'histograms': [[name, list(labels), dict(hist, buckets=list(hist['buckets']))]
+                               for (name, labels), hist in self.histograms.items()],
+            }
+
+metrics = MetricsRegistry()
+
+def worker_metrics():
+    """The registry for this process (a forked worker starts with an empty one)"""
+    global metrics
+    if metrics.pid != os.getpid():
+        metrics = MetricsRegistry()
+    return metrics
+
+def metrics_file_path(registry):
+    return os.path.join(app.config['METRICS_DIR'], f"worker-{registry.pid}-{int(registry.started)}.json")
+
+def flush_metrics(force=False):
+    """Write this worker's snapshot for /metrics, at most every METRICS_FLUSH_INTERVAL seconds"""
+    registry = worker_metrics()
+    now = time.time()
+    if not force and now - registry.last_flush < app.config['METRICS_FLUSH_INTERVAL']:
+        return
+    registry.last_flush = now
+    try:
+        os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+        path = metrics_file_path(registry)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(registry.snapshot(), f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print(f"⚠️ Could not write metrics snapshot: {e}")
+
+atexit.register(lambda: flush_metrics(force=True) if metrics.counters else None)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def merge_metric_snapshots(snapshots, include_gauges=True):
+    counters, gauges, histograms = {}, {}, {}
+    for snap in snapshots:
+        for name, labels, value in snap.get('counters', []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        if include_gauges:
+            for name, labels, value in snap.get('gauges', []):
+                key = (name, tuple(tuple(pair) for pair in labels))
+                gauges[key] = gauges.get(key, 0) + value
+        for name, labels, hist in snap.get('histograms', []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            merged = histograms.setdefault(key, {'buckets': [0] * len(hist['buckets']), 'sum': 0.0, 'count': 0})
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'], hist['buckets'])]
+            merged['sum'] += hist['sum']
+            merged['count'] += hist['count']
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+        'gauges': [[name, list(labels), value] for (name, labels), value in gauges.items()],
+        'histograms': [[name, list(labels), hist] for (name, labels), hist in histograms.items()],
+    }
+
+def collect_metric_snapshots():
+    """Read every worker's snapshot. Snapshots of exited workers are folded into
+    archive.json so their counts survive worker recycling (max_requests)"""
+    flush_metrics(force=True)
+    metrics_dir = app.config['METRICS_DIR']
+    archive_path = os.path.join(metrics_dir, 'archive.json')
+    live, dead, dead_paths = [], [], []
+    for filename in sorted(os.listdir(metrics_dir)):
+        if not (filename.startswith('worker-') and filename.endswith('.json')):
+            continue
+        path = os.path.join(metrics_dir, filename)
+        try:
+            with open(path) as f:
+                snap = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if _pid_alive(snap.get('pid', 0)):
+            live.append(snap)
+        else:
+            dead.append(snap)
+            dead_paths.append(path)
+    
+    archive = {}
+    if os.path.exists(archive_path):
+        try:
+            with open(archive_path) as f:
+                archive = json.load(f)
+        except (OSError, ValueError):
+            archive = {}
+    
+    if dead:
+        # Another worker may be serving /metrics at the same moment; only one may fold
+        # a dead snapshot into the archive or it would be counted twice
+        with open(os.path.join(metrics_dir, 'archive.lock'), 'w') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            dead = [snap for snap, path in zip(dead, dead_paths) if os.path.exists(path)]
+            if os.path.exists(archive_path):
+                try:
+                    with open(archive_path) as f:
+                        archive = json.load(f)
+                except (OSError, ValueError):
+                    archive = {}
+            archive = merge_metric_snapshots([archive] + dead, include_gauges=False)
+            with open(archive_path + '.tmp', 'w') as f:
+                json.dump(archive, f)
+            os.replace(archive_path + '.tmp', archive_path)
+            for path in dead_paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    
+    return [archive] + live
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = []
+    for key, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+def render_metrics(snapshot):
+    """Prometheus text exposition format (0.0.4)"""
+    series = {}
+    for kind in ('counters', 'gauges', 'histograms'):
+        for name, labels, value in snapshot.get(kind, []):
+            series.setdefault(name, []).append((labels, value))
+    
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in sorted(series.get(name, []), key=lambda item: item[0]):
+            if metric_type != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), value['buckets']):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels, ("le", bound))} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {value["sum"]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {value["count"]}')
+    return '\n'.join(lines) + '\n'
+
+@contextmanager
+def timed_external_call(service):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        worker_metrics().observe('dzkeyz_external_call_duration_seconds', time.perf_counter() - started, service=service)
+
+def record_cache_lookup(cache, hit):
+    worker_metrics().inc('dzkeyz_cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+# Fragment cache: HTML that is the same for every visitor (product cards, the offers slider),
+# rendered once per worker. Keys carry the catalog version and the template's version, so edits
+# to products, categories or tags (and template changes) never serve stale markup.
+class FragmentCache:
+    """Thread-safe LRU of rendered fragments, bounded by their total size in bytes"""
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.version = None
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+    
+    def set(self, key, value, size=None):
+        """Store value; size defaults to its UTF-8 length, pass it for anything that isn't a str"""
+        if size is None:
+            size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+    
+    def sync_version(self, version):
+        """Drop everything rendered for an older catalog; those keys can never be hit again"""
+        with self.lock:
+            if self.version != version:
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+fragment_cache = FragmentCache(app.config['FRAGMENT_CACHE_MAX_BYTES'])
+_template_versions = {}
+
+def template_version(template_name):
+    """Short hash of a template's source, so cached fragments go stale when it changes"""
+    version = _template_versions.get(template_name)
+    if version is None or app.jinja_env.auto_reload:
+        source, _, _ = app.jinja_env.loader.get_source(app.jinja_env, template_name)
+        version = hashlib.sha1(source.encode('utf-8')).hexdigest()[:12]
+        _template_versions[template_name] = version
+    return version
+
+def fragment_key(template_name, catalog_version, *parts):
+    return (template_name, template_version(template_name), catalog_version) + parts
+
+# Page cache: whole storefront responses for anonymous visitors. Entries are
+# (body, etag, mimetype, expires_at); stock counts and reviews don't move the catalog
+# version, so PAGE_CACHE_TTL bounds how stale those can get.
+page_cache = FragmentCache(app.config['PAGE_CACHE_MAX_BYTES'])
+
+def get_page_cache_version(conn=None):
+    """(catalog version, branding version): cached pages show both the catalog and the store settings"""
+    versions = get_cache_versions(conn)
+    return versions.get('catalog', 0), versions.get('branding', 0)
+
+def is_anonymous_request():
+    """No logged-in user or admin and no pending flash messages, so the page is the same for everyone"""
+    return not (session.get('user_id') or session.get('admin_logged_in') or session.get('_flashes'))
+
+def cached_page(f):
+    """Serve anonymous GETs of a storefront view from page_cache, with a strong ETag.
+    
+    Goes under @app.route like admin_required. Query strings, non-200 responses and responses
+    that change the session are never cached; PAGE_CACHE_EXCLUDE turns it off per endpoint.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        ttl = app.config['PAGE_CACHE_TTL']
+        if (ttl <= 0 or request.method != 'GET' or request.query_string or g.get('profiler')
+                or request.endpoint in app.config['PAGE_CACHE_EXCLUDE'] or not is_anonymous_request()):
+            return f(*args, **kwargs)
+        
+        page_cache.sync_version(get_page_cache_version())
+        now = time.time()
+        entry = page_cache.get(request.path)
+        if entry is not None and entry[3] <= now:
+            entry = None
+        record_cache_lookup('pages', entry is not None)
+        
+        if entry is None:
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200 or response.direct_passthrough or session.modified:
+                return response
+            body = response.get_data()
+            entry = (body, hashlib.sha1(body).hexdigest(), response.mimetype, now + ttl)
+            page_cache.set(request.path, entry, size=len(body))
+        
+        body, etag, mimetype, _ = entry
+        response = app.response_class(body, mimetype=mimetype)
+        response.set_etag(etag)
+        # Browsers and CDNs keep the page but revalidate it, getting a 304 while it's unchanged;
+        # logged-in visitors send a different cookie and never see the shared copy
+        response.headers['Cache-Control'] = 'no-cache'
+        response.vary.add('Cookie')
+        return response.make_conditional(request)
+    return decorated_function
+
+@app.before_request
+def track_request_start():
+    worker_metrics().add_gauge('dzkeyz_requests_in_flight', 1)
+    g.in_flight = True
+
+@app.teardown_request
+def track_request_end(exc=None):
+    if g.pop('in_flight', False):
+        worker_metrics().add_gauge('dzkeyz_requests_in_flight', -1)
+        flush_metrics()
+    flush_slow_queries()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is None or request.endpoint == 'static':
+        return response
+    registry = worker_metrics()
+    endpoint = request.endpoint or 'unmatched'
+    registry.inc('dzkeyz_http_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+    registry.observe('dzkeyz_http_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+    return response
+
+_db_initialized = False
+_db_init_lock = threading.Lock()
+
+def ensure_db():
+    """Run init_db once per process, on first use rather than at import"""
+    global _db_initialized
+    if _db_initialized:
+        return
+    with _db_init_lock:
+        if _db_initialized:
+            return
+        try:
+            init_db()
+            print("✅ Database initialized successfully")
+        except Exception as e:
+            print(f"⚠️ Database initialization warning: {e}")
+            # Continue anyway - database might already exist
+        _db_initialized = True
+
+@app.before_request
+def ensure_db_before_request():
+    ensure_db()
+
+def warm_caches():
+    """Load landing pages (with their rendered cards), bundles and branding before traffic arrives.
+    
+    Called from gunicorn's when_ready with a preloaded app, so forked workers start warm.
+    """
+    try:
+        with app.test_request_context('/'):
+            conn = get_db()
+            try:
+                landing_pages = get_landing_pages(conn)
+                for _, products in landing_pages.values():
+                    render_product_cards(conn, products)
+                get_bundle_catalog(conn)
+            finally:
+                conn.close()
+            get_branding_settings()
+        print(f"✅ Caches warmed: {len(landing_pages)} landing pages")
+    except Exception as e:
+        # Cold caches only cost the first requests some queries
+        print(f"⚠️ Cache warm-up failed: {e}")
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create or migrate the database schema"""
     init_db()
     print("✅ Database initialized successfully")
-except Exception as e:
-    print(f"⚠️ Database initialization warning: {e}")
-    # Continue anyway - database might already exist
+
+# Request profiling. The profiler is started after the other before_request hooks and
+# stopped before the other after_request hooks, so it covers the view and template rendering.
+@app.before_request
+def start_profiler():
+    if request.endpoint == 'static':
+        return
+    if ((request.args.get('_profile') == '1' or request.headers.get('X-Profile') == '1')
+            and session.get('admin_logged_in')):
+        trigger = 'admin'
+    elif app.config['PROFILE_SAMPLE_RATE'] > 0 and random.random() < app.config['PROFILE_SAMPLE_RATE']:
+        trigger = 'sampled'
+    else:
+        return
+    
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is already running in this thread
+        return
+    g.profiler = profiler
+    g.profile_trigger = trigger
+
+@app.after_request
+def save_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    
+    trigger = g.pop('profile_trigger')
+    duration_ms = (time.perf_counter() - g.request_started) * 1000
+    if trigger == 'sampled' and duration_ms < app.config['PROFILE_SLOW_MS']:
+        return response
+    try:
+        profile_id = store_profile(profiler, trigger, response.status_code, duration_ms)
+        if trigger == 'admin':
+            response.headers['X-Profile-Id'] = str(profile_id)
+    except (OSError, sqlite3.Error) as e:
+        print(f"⚠️ Could not save profile: {e}")
+    return response
+
+@app.teardown_request
+def stop_profiler(exc=None):
+    # Only still set when the view raised and after_request never ran
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+
+def store_profile(profiler, trigger, status, duration_ms):
+    """Write the pstats dump, record it and drop profiles beyond PROFILE_KEEP"""
+    profile_dir = app.config['PROFILE_DIR']
+    os.makedirs(profile_dir, exist_ok=True)
+    filename = f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{uuid.uuid4().hex[:8]}.prof"
+    profiler.dump_stats(os.path.join(profile_dir, filename))
+    
+    conn = get_db()
+    cursor = conn.execute('''INSERT INTO request_profiles 
+                             (method, path, endpoint, status, duration_ms, db_queries, db_ms, trigger, filename) 
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                          (request.method, request.full_path.rstrip('?'), request.endpoint, status,
+                           round(duration_ms, 2), g.get('db_queries', 0),
+                           round(g.get('db_time', 0.0) * 1000, 2), trigger, filename))
+    profile_id = cursor.lastrowid
+    stale = conn.execute('SELECT id, filename FROM request_profiles ORDER BY id DESC LIMIT -1 OFFSET ?',
+                         (app.config['PROFILE_KEEP'],)).fetchall()
+    for row in stale:
+        delete_profile_file(row['filename'])
+    conn.executemany('DELETE FROM request_profiles WHERE id = ?', [(row['id'],) for row in stale])
+    conn.commit()
+    conn.close()
+    return profile_id
+
+def delete_profile_file(filename):
+    try:
+        os.remove(os.path.join(app.config['PROFILE_DIR'], filename))
+    except FileNotFoundError:
+        pass
 
 def get_db():
-    conn = sqlite3.connect('store.db')
+    conn = sqlite3.connect('store.db', timeout=app.config['SQLITE_BUSY_TIMEOUT'], factory=InstrumentedConnection)
+    worker_metrics().inc('dzkeyz_db_connections_total')
     conn.row_factory = sqlite3.Row
+    # Safe with WAL and avoids an fsync on every commit
+    conn.execute('PRAGMA synchronous=NORMAL')
     return conn
 
 def log_action(order_id, action, actor, note=None):
@@ -596,6 +1816,8 @@ def generate_receipt_pdf(order_data):
         from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
         from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
         from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
+        from reportlab.lib.pagesizes import letter
+        from reportlab.lib.units import inch
         from datetime import datetime
         
         # Create filename
@@ -828,6 +2050,9 @@ def generate_receipt_pdf(order_data):
         
         # Fallback to simple PDF
         try:
+            from reportlab.lib.pagesizes import letter
+            from reportlab.pdfgen import canvas
+
             receipt_filename = f"receipt_{order_data['id']}.pdf"
             receipt_path = os.path.join('receipts', receipt_filename)
             
@@ -952,7 +2177,6 @@ def send_activation_email(user_email, user_name, activation_link):
         
         print(f"📧 Sending activation email to: {user_email}")
         print(f"📧 Activation link: {activation_link}")
-        print(f"📧 API Key: {resend_key[:10]}...{resend_key[-4:]}")
         
         # Email data
         data = {
@@ -981,24 +2205,29 @@ def send_activation_email(user_email, user_name, activation_link):
             "Content-Type": "application/json"
         }
         
-        response = requests.post("https://api.resend.com/emails", json=data, headers=headers)
+        with timed_external_call('resend'):
+            response = requests.post("https://api.resend.com/emails", json=data, headers=headers)
         
         if response.status_code == 200:
             result = response.json()
             print(f"✅ Email sent successfully! ID: {result.get('id', 'Unknown')}")
+            worker_metrics().inc('dzkeyz_emails_total', result='sent')
             return True
         else:
             print(f"❌ Email sending failed: {response.status_code} - {response.text}")
+            worker_metrics().inc('dzkeyz_emails_total', result='failed')
             return False
             
     except Exception as e:
         print(f"❌ Email sending error: {e}")
         import traceback
         traceback.print_exc()
+        worker_metrics().inc('dzkeyz_emails_total', result='failed')
         return False
 
 def send_email(to, subject, body, customer_name=None, email_type="general", attachment_path=None):
     """Send email using Resend.com official Python SDK with professional formatting"""
+    import resend
     try:
         # Load environment variables manually (more reliable)
         env_vars = {}
@@ -1021,7 +2250,6 @@ def send_email(to, subject, body, customer_name=None, email_type="general", atta
         print(f"📧 Sending email via Resend.com SDK to: {to}")
         print(f"📧 From: {from_name} <{from_email}>")
         print(f"📧 Subject: {subject}")
-        print(f"📧 API Key: {api_key[:10] + '...' + api_key[-4:] if api_key else 'MISSING'}")
         
         if not api_key:
             print("❌ Email sending failed: Missing RESEND_API_KEY in .env")
@@ -1089,13 +2317,15 @@ def send_email(to, subject, body, customer_name=None, email_type="general", atta
         print("📧 Sending email via Resend.com SDK...")
         
         # Send the email using official SDK format
-        email_response = resend.Emails.send(params)
+        with timed_external_call('resend'):
+            email_response = resend.Emails.send(params)
         
         email_id = email_response.get('id', 'Unknown')
         
         print(f"✅ Email sent successfully to {to}")
         print(f"📧 Email ID: {email_id}")
         print("📧 Resend.com SDK - excellent deliverability!")
+        worker_metrics().inc('dzkeyz_emails_total', result='sent')
         return True
         
     except Exception as e:
@@ -1103,10 +2333,12 @@ def send_email(to, subject, body, customer_name=None, email_type="general", atta
         print(f"❌ Error type: {type(e).__name__}")
         import traceback
         traceback.print_exc()
+        worker_metrics().inc('dzkeyz_emails_total', result='failed')
         return False
 
 def send_bot_message(chat_id, message):
     """Send a message from the bot to a specific chat"""
+    import requests
     bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
     if not bot_token:
         return False
@@ -1118,13 +2350,15 @@ def send_bot_message(chat_id, message):
             "text": message,
             "parse_mode": "Markdown"
         }
-        response = requests.post(url, json=data)
+        with timed_external_call('telegram'):
+            response = requests.post(url, json=data)
         return response.status_code == 200
     except Exception as e:
         print(f"Failed to send bot message: {e}")
         return False
 
 def send_telegram_notification(message, order_id=None, payment_proof_path=None):
+    import requests
     bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
     admin_id = os.getenv('TELEGRAM_ADMIN_ID')
     
@@ -1156,7 +2390,8 @@ def send_telegram_notification(message, order_id=None, payment_proof_path=None):
                 if keyboard:
                     data['reply_markup'] = json.dumps(keyboard)
                 
-                response = requests.post(url, files=files, data=data)
+                with timed_external_call('telegram'):
+                    response = requests.post(url, files=files, data=data)
                 
                 if response.status_code == 200:
                     return True
@@ -1165,6 +2400,8 @@ def send_telegram_notification(message, order_id=None, payment_proof_path=None):
         
         except Exception as e:
             print(f"Failed to send payment proof image: {e}")
+        
+        worker_metrics().inc('dzkeyz_telegram_retries_total', reason='photo_failed')
     
     # Fallback to text message
     try:
@@ -1178,7 +2415,8 @@ def send_telegram_notification(message, order_id=None, payment_proof_path=None):
         if keyboard:
             data["reply_markup"] = keyboard
         
-        response = requests.post(url, json=data)
+        with timed_external_call('telegram'):
+            response = requests.post(url, json=data)
         return response.status_code == 200
     except Exception as e:
         print(f"Telegram notification failed: {e}")
@@ -1224,65 +2462,46 @@ def health_check():
         }
     }
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint covering every worker"""
+    token = app.config['METRICS_TOKEN']
+    supplied = request.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+    authorized = (
+        (token and hmac.compare_digest(supplied.encode(), token.encode()))
+        or session.get('admin_logged_in')
+        # Behind nginx every request comes from loopback, so this is opt-in
+        or (app.config['METRICS_ALLOW_LOCALHOST'] and request.remote_addr in ('127.0.0.1', '::1'))
+    )
+    if not authorized:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    snapshot = merge_metric_snapshots(collect_metric_snapshots())
+    return app.response_class(render_metrics(snapshot), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
+@cached_page
 def index():
     try:
         conn = get_db()
         
-        # Get visible products only
-        products_raw = conn.execute('''
-            SELECT p.*, c.name as category_name, c.icon as category_icon
-            FROM products p
-            LEFT JOIN categories c ON p.category_id = c.id
-            WHERE p.is_visible = TRUE AND (p.stock_count > 0 OR p.type != 'key')
-            ORDER BY p.is_featured DESC, p.created_at DESC
-        ''').fetchall()
+        # First page of visible products; the grid loads the rest from /api/catalog as it scrolls
+        products_raw, next_cursor = get_catalog_page(conn)
     except Exception as e:
-        # If database fails, show a simple page
-        return f"<h1>DZ Keyz Store</h1><p>Setting up... Database error: {str(e)}</p><p><a href='/health'>Health Check</a></p>"
+        # If database fails, show a simple page; the 503 keeps it out of the page cache
+        print(f"❌ Home page database error: {e}")
+        return "<h1>DZ Keyz Store</h1><p>Setting up... please try again in a moment.</p><p><a href='/health'>Health Check</a></p>", 503
     
-    products = []
-    for product in products_raw:
-        product_dict = dict(product)
-        product_dict['image_urls'] = get_product_images(product['images'])
-        product_dict['main_image'] = product_dict['image_urls'][0] if product_dict['image_urls'] else None
-        product_dict['tags'] = get_product_tags(product['id'])
-        
-        # Check stock status for key products
-        if product['type'] == 'key' and product['stock_limit']:
-            available_keys = conn.execute(
-                'SELECT COUNT(*) FROM product_keys WHERE product_id = ? AND is_used = FALSE',
-                (product['id'],)
-            ).fetchone()[0]
-            product_dict['available_stock'] = available_keys
-            product_dict['is_in_stock'] = available_keys > 0
-        else:
-            product_dict['available_stock'] = None
-            product_dict['is_in_stock'] = True
-            
-        products.append(product_dict)
+    # Cards are rendered once per catalog version and reused (see render_product_cards)
+    product_cards = render_product_cards(conn, products_raw)
     
-    # Get visible bundles
-    bundles = []
-    bundles_raw = conn.execute('SELECT * FROM bundles WHERE is_visible = TRUE ORDER BY created_at DESC').fetchall()
-    for bundle in bundles_raw:
-        bundle_dict = dict(bundle)
-        bundle_dict['image_urls'] = get_product_images(bundle['images'])
-        bundle_dict['main_image'] = bundle_dict['image_urls'][0] if bundle_dict['image_urls'] else None
-        bundle_dict['original_price'] = conn.execute('''
-            SELECT SUM(p.price_dzd) FROM products p
-            JOIN bundle_products bp ON p.id = bp.product_id
-            WHERE bp.bundle_id = ?
-        ''', (bundle['id'],)).fetchone()[0] or 0
-        bundle_dict['final_price'] = calculate_bundle_price(bundle['id'])
-        bundle_dict['savings'] = bundle_dict['original_price'] - bundle_dict['final_price']
-        bundles.append(bundle_dict)
+    # Get visible bundles (priced once per catalog change, see get_bundle_catalog)
+    bundles = [bundle for bundle in get_bundle_catalog(conn) if bundle['is_visible']]
     
     # Get categories for filtering
     categories = get_categories()
     
     # Get special offers for homepage slider
-    special_offers = []
     special_offers_raw = conn.execute('''
         SELECT p.*, c.name as category_name, c.icon as category_icon
         FROM products p
@@ -1292,42 +2511,239 @@ def index():
         LIMIT 5
     ''').fetchall()
     
-    for offer in special_offers_raw:
-        offer_dict = dict(offer)
-        offer_dict['image_urls'] = get_product_images(offer['images'])
-        offer_dict['main_image'] = offer_dict['image_urls'][0] if offer_dict['image_urls'] else None
-        offer_dict['tags'] = get_product_tags(offer['id'])
-        
-        # Use banner image if available, otherwise use main product image
-        if offer['banner_image']:
-            offer_dict['banner_url'] = f"/static/banners/{offer['banner_image']}"
-        else:
-            offer_dict['banner_url'] = offer_dict['main_image']
-        
-        special_offers.append(offer_dict)
+    special_offers_html = render_special_offers(conn, special_offers_raw)
     
     conn.close()
-    return render_template('index.html', products=products, bundles=bundles, categories=categories, special_offers=special_offers)
+    return render_template('index.html', products=products_raw, product_cards=product_cards, next_cursor=next_cursor,
+                           bundles=bundles, categories=categories, special_offers_html=special_offers_html)
+
+@app.route('/api/catalog')
+def catalog_api():
+    """Storefront catalog, a page at a time.
+    
+    Filters: category (id), tag (id), type (key|file), min_price, max_price. sort is one of
+    CATALOG_SORTS; pass next_cursor back as cursor for the following page. html holds the
+    rendered cards for the home page's infinite scroll.
+    """
+    sort = request.args.get('sort', 'featured')
+    if sort not in CATALOG_SORTS:
+        return jsonify({'error': f"sort must be one of {', '.join(CATALOG_SORTS)}"}), 400
+    try:
+        filters = parse_catalog_filters(request.args)
+        limit = int(request.args.get('limit', app.config['CATALOG_PAGE_SIZE']))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid filter: {e}'}), 400
+    limit = max(1, min(limit, app.config['CATALOG_MAX_PAGE_SIZE']))
+    
+    conn = get_db()
+    try:
+        rows, next_cursor = get_catalog_page(conn, filters, sort, request.args.get('cursor'), limit)
+    except ValueError:
+        conn.close()
+        return jsonify({'error': 'Invalid cursor'}), 400
+    cards = render_product_cards(conn, rows)
+    conn.close()
+    
+    products = []
+    for row in rows:
+        image_urls = get_product_images(row['images'])
+        products.append({
+            'id': row['id'],
+            'name': row['name'],
+            'price_dzd': row['price_dzd'],
+            'type': row['type'],
+            'stock_count': row['stock_count'],
+            'category_id': row['category_id'],
+            'category_name': row['category_name'],
+            'is_featured': bool(row['is_featured']),
+            'image_url': image_urls[0] if image_urls else None,
+            'url': url_for('product_details', product_id=row['id']),
+        })
+    return jsonify({'products': products, 'html': ''.join(cards), 'next_cursor': next_cursor})
+
+def rebuild_rating_summaries(conn):
+    """Recompute product_rating_summary from the reviews table"""
+    conn.execute('DELETE FROM product_rating_summary')
+    conn.execute('''INSERT INTO product_rating_summary 
+                    (product_id, review_count, rating_sum, stars_1, stars_2, stars_3, stars_4, stars_5)
+                    SELECT product_id, COUNT(*), SUM(rating), SUM(rating = 1), SUM(rating = 2), 
+                           SUM(rating = 3), SUM(rating = 4), SUM(rating = 5)
+                    FROM reviews GROUP BY product_id''')
+
+def get_rating_summary(conn, product_id):
+    """Review count, average rating and star histogram (5 down to 1) for a product"""
+    row = conn.execute('SELECT * FROM product_rating_summary WHERE product_id = ?', (product_id,)).fetchone()
+    count = row['review_count'] if row else 0
+    return {
+        'review_count': count,
+        'average_rating': round(row['rating_sum'] / count, 1) if count else 0,
+        'histogram': [(stars, row[f'stars_{stars}'] if row else 0) for stars in range(5, 0, -1)],
+    }
+
+def encode_cursor(values):
+    """Opaque keyset pagination cursor for the sort key of the last row on a page"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, length):
+    """Inverse of encode_cursor; None for a missing or malformed cursor (the values go
+    straight into SQL parameters, so only strings and numbers are accepted)"""
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != length:
+        return None
+    if not all(isinstance(value, (str, int, float)) for value in values):
+        return None
+    return values
+
+def get_review_page(conn, product_id, cursor=None):
+    """One page of reviews, newest first, and the cursor for the next page (or None).
+    Raises ValueError for a cursor that doesn't decode."""
+    page_size = app.config['REVIEWS_PAGE_SIZE']
+    query = '''SELECT r.id, r.rating, r.comment, r.created_at, u.name as user_name
+               FROM reviews r
+               JOIN users u ON r.user_id = u.id
+               WHERE r.product_id = ?'''
+    params = [product_id]
+    after = decode_cursor(cursor, 2)
+    if cursor and not after:
+        raise ValueError('invalid cursor')
+    if after:
+        query += ' AND (r.created_at < ? OR (r.created_at = ? AND r.id < ?))'
+        params += [after[0], after[0], after[1]]
+    query += ' ORDER BY r.created_at DESC, r.id DESC LIMIT ?'
+    params.append(page_size + 1)
+    rows = conn.execute(query, params).fetchall()
+    
+    reviews = []
+    for review in rows[:page_size]:
+        review_dict = dict(review)
+        # Format date
+        if review_dict.get('created_at'):
+            try:
+                dt = datetime.strptime(review_dict['created_at'], '%Y-%m-%d %H:%M:%S')
+                review_dict['created_at_formatted'] = dt.strftime('%B %d, %Y')
+            except ValueError:
+                review_dict['created_at_formatted'] = review_dict['created_at']
+        reviews.append(review_dict)
+    
+    next_cursor = None
+    if len(rows) > page_size:
+        last = reviews[-1]
+        next_cursor = encode_cursor([last['created_at'], last['id']])
+    return reviews, next_cursor
+
+# Storefront catalog sorts: ORDER BY columns (all one direction, so a keyset cursor is a single
+# row-value comparison) and that direction
+CATALOG_SORTS = {
+    'featured': (('is_featured', 'created_at', 'id'), 'DESC'),
+    'newest': (('created_at', 'id'), 'DESC'),
+    'price_asc': (('price_dzd', 'id'), 'ASC'),
+    'price_desc': (('price_dzd', 'id'), 'DESC'),
+}
+
+def parse_catalog_filters(args):
+    """Validate /api/catalog query arguments into filters for get_catalog_page (ValueError if invalid)"""
+    filters = {}
+    for name in ('category', 'tag'):
+        if args.get(name):
+            filters[name] = int(args[name])
+    if args.get('type'):
+        if args['type'] not in ('key', 'file'):
+            raise ValueError('type must be key or file')
+        filters['type'] = args['type']
+    for name in ('min_price', 'max_price'):
+        if args.get(name):
+            filters[name] = float(args[name])
+    return filters
+
+def get_catalog_page(conn, filters=None, sort='featured', cursor=None, limit=None):
+    """One page of visible, buyable products and the cursor for the next page (or None).
+    Raises ValueError for a cursor that doesn't decode."""
+    filters = filters or {}
+    limit = limit or app.config['CATALOG_PAGE_SIZE']
+    columns, direction = CATALOG_SORTS[sort]
+    
+    query = '''SELECT p.*, c.name as category_name, c.icon as category_icon
+               FROM products p
+               LEFT JOIN categories c ON p.category_id = c.id
+               WHERE p.is_visible = TRUE AND (p.stock_count > 0 OR p.type != 'key')'''
+    params = []
+    if 'category' in filters:
+        query += ' AND p.category_id = ?'
+        params.append(filters['category'])
+    if 'tag' in filters:
+        query += ' AND EXISTS (SELECT 1 FROM product_tags pt WHERE pt.product_id = p.id AND pt.tag_id = ?)'
+        params.append(filters['tag'])
+    if 'type' in filters:
+        query += ' AND p.type = ?'
+        params.append(filters['type'])
+    if 'min_price' in filters:
+        query += ' AND p.price_dzd >= ?'
+        params.append(filters['min_price'])
+    if 'max_price' in filters:
+        query += ' AND p.price_dzd <= ?'
+        params.append(filters['max_price'])
+    
+    sort_key = ', '.join(f'p.{column}' for column in columns)
+    after = decode_cursor(cursor, len(columns))
+    if cursor and not after:
+        raise ValueError('invalid cursor')
+    if after:
+        query += f" AND ({sort_key}) {'<' if direction == 'DESC' else '>'} ({', '.join('?' * len(columns))})"
+        params += after
+    query += f" ORDER BY {', '.join(f'p.{column} {direction}' for column in columns)} LIMIT ?"
+    params.append(limit + 1)
+    rows = conn.execute(query, params).fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][column] for column in columns])
+    return rows, next_cursor
+
+# The logged-in user's relationship to a product, selected together with the product row so
+# the product page runs the same queries whether or not someone is logged in. Each EXISTS is an
+# index lookup on (user_id, product_id); with :user_id NULL they match nothing.
+USER_PRODUCT_STATE_COLUMNS = '''
+    EXISTS(SELECT 1 FROM orders o WHERE o.user_id = :user_id AND o.product_id = p.id AND o.status = 'confirmed') AS user_purchased,
+    EXISTS(SELECT 1 FROM reviews r WHERE r.user_id = :user_id AND r.product_id = p.id) AS user_reviewed,
+    EXISTS(SELECT 1 FROM wishlists w WHERE w.user_id = :user_id AND w.product_id = p.id) AS user_wishlisted'''
 
 @app.route('/product/<int:product_id>')
+@cached_page
 def product_details(product_id):
     conn = get_db()
-    product_raw = conn.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
+    product_raw = conn.execute(f'SELECT p.*, {USER_PRODUCT_STATE_COLUMNS} FROM products p WHERE p.id = :product_id',
+                               {'product_id': product_id, 'user_id': session.get('user_id')}).fetchone()
     
     if not product_raw:
+        conn.close()
         flash('Product not found', 'error')
         return redirect(url_for('index'))
     
     # Convert to dict and add image data
     product = dict(product_raw)
+    purchased = product.pop('user_purchased')
+    reviewed = product.pop('user_reviewed')
+    is_wishlisted = bool(product.pop('user_wishlisted'))
     product['image_urls'] = get_product_images(product['images'])
     product['main_image'] = product['image_urls'][0] if product['image_urls'] else None
     
-    # Get related products (same type, excluding current product)
-    related_products_raw = conn.execute('''SELECT * FROM products 
-                                          WHERE type = ? AND id != ? AND stock_count > 0 
-                                          ORDER BY created_at DESC LIMIT 3''', 
-                                       (product['type'], product_id)).fetchall()
+    # Related products precomputed by rebuild_related_products, limited to ones that can be bought now
+    related_products_raw = conn.execute('''SELECT p.* FROM related_products r
+                                          JOIN products p ON p.id = r.related_id
+                                          WHERE r.product_id = ? AND p.is_visible = TRUE AND p.stock_count > 0
+                                          ORDER BY r.score DESC LIMIT 3''', (product_id,)).fetchall()
+    if not related_products_raw:
+        # Not computed yet (new product, or before the first rebuild): same type, newest first
+        related_products_raw = conn.execute('''SELECT * FROM products 
+                                              WHERE type = ? AND id != ? AND stock_count > 0 
+                                              ORDER BY created_at DESC LIMIT 3''', 
+                                           (product['type'], product_id)).fetchall()
     
     related_products = []
     for related in related_products_raw:
@@ -1336,63 +2752,34 @@ def product_details(product_id):
         related_dict['main_image'] = related_dict['image_urls'][0] if related_dict['image_urls'] else None
         related_products.append(related_dict)
     
-    # Get reviews
-    reviews_raw = conn.execute('''
-        SELECT r.*, u.name as user_name
-        FROM reviews r
-        JOIN users u ON r.user_id = u.id
-        WHERE r.product_id = ?
-        ORDER BY r.created_at DESC
-    ''', (product_id,)).fetchall()
+    # First page of reviews; the rating aggregate comes from product_rating_summary
+    reviews, next_reviews_cursor = get_review_page(conn, product_id)
+    rating_summary = get_rating_summary(conn, product_id)
 
-    reviews = []
-    total_rating = 0
-    for review in reviews_raw:
-        review_dict = dict(review)
-        # Format date
-        if review_dict.get('created_at'):
-            try:
-                dt = datetime.strptime(review_dict['created_at'], '%Y-%m-%d %H:%M:%S')
-                review_dict['created_at_formatted'] = dt.strftime('%B %d, %Y')
-            except:
-                review_dict['created_at_formatted'] = review_dict['created_at']
-        reviews.append(review_dict)
-        total_rating += review['rating']
-
-    review_count = len(reviews)
-    average_rating = round(total_rating / review_count, 1) if review_count > 0 else 0
-
-    # Check if current user can review
-    can_review = False
-    if session.get('user_id'):
-        user_id = session.get('user_id')
-
-        # Check if bought
-        has_bought = conn.execute('''
-            SELECT id FROM orders
-            WHERE user_id = ? AND product_id = ? AND status = 'confirmed'
-        ''', (user_id, product_id)).fetchone()
-
-        # Check if already reviewed
-        has_reviewed = conn.execute('''
-            SELECT id FROM reviews WHERE user_id = ? AND product_id = ?
-        ''', (user_id, product_id)).fetchone()
-
-        if has_bought and not has_reviewed:
-            can_review = True
-
-    # Check if wishlisted
-    is_wishlisted = False
-    if session.get('user_id'):
-        wishlist_item = conn.execute('SELECT id FROM wishlists WHERE user_id = ? AND product_id = ?',
-                                   (session.get('user_id'), product_id)).fetchone()
-        if wishlist_item:
-            is_wishlisted = True
+    # Buyers can review a product once
+    can_review = bool(purchased and not reviewed)
 
     conn.close()
     
     return render_template('product_details.html', product=product, related_products=related_products,
-                         reviews=reviews, average_rating=average_rating, review_count=review_count, can_review=can_review, is_wishlisted=is_wishlisted)
+                         reviews=reviews, next_reviews_cursor=next_reviews_cursor,
+                         average_rating=rating_summary['average_rating'], review_count=rating_summary['review_count'],
+                         rating_histogram=rating_summary['histogram'], can_review=can_review, is_wishlisted=is_wishlisted)
+
+@app.route('/product/<int:product_id>/reviews')
+def product_reviews(product_id):
+    """Next page of reviews for the product page's "Load more" button"""
+    conn = get_db()
+    try:
+        reviews, next_cursor = get_review_page(conn, product_id, request.args.get('cursor'))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    finally:
+        conn.close()
+    return jsonify({
+        'html': render_template('_review_items.html', reviews=reviews),
+        'next_cursor': next_cursor,
+    })
 
 @app.route('/buy/<int:product_id>')
 def buy_product(product_id):
@@ -1416,7 +2803,30 @@ def buy_product(product_id):
         'ccp_key': os.getenv('CCP_KEY', '12')
     }
     
-    return render_template('buy.html', product=product, payment_config=payment_config)
+    # Sent back with the form so a double-click or a retried submit returns the same order
+    idempotency_key = uuid.uuid4().hex
+    
+    return render_template('buy.html', product=product, payment_config=payment_config, idempotency_key=idempotency_key)
+
+IDEMPOTENCY_KEY_RE = re.compile(r'[A-Za-z0-9_-]{16,64}')
+
+def find_duplicate_transaction(conn, payment_method, transaction_id):
+    """id of a pending or confirmed order already paid with this transaction, or None"""
+    if not transaction_id:
+        return None
+    # Repeats the WHERE of the partial index idx_orders_payment_transaction so SQLite can use it
+    row = conn.execute('''SELECT id FROM orders
+                          WHERE payment_method = ? AND transaction_id = ? AND status != 'rejected'
+                            AND transaction_id IS NOT NULL AND payment_method IN ('baridimob', 'ccp')
+                          LIMIT 1''', (payment_method, transaction_id)).fetchone()
+    return row['id'] if row else None
+
+def remove_upload(filename):
+    if filename:
+        try:
+            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        except OSError:
+            pass
 
 @app.route('/submit_order', methods=['POST'])
 def submit_order():
@@ -1426,10 +2836,23 @@ def submit_order():
     phone = request.form.get('phone')
     telegram_username = request.form.get('telegram_username')
     payment_method = request.form.get('payment_method')
-    transaction_id = request.form.get('transaction_id')
+    transaction_id = (request.form.get('transaction_id') or '').strip() or None
+    idempotency_key = (request.form.get('idempotency_key') or '').strip()
+    if not IDEMPOTENCY_KEY_RE.fullmatch(idempotency_key):
+        idempotency_key = None
     
-    # Get product info to check if it's free
     conn = get_db()
+    
+    # A resubmitted form (double-click, mobile retry) gets the order it already created,
+    # without another upload, notification or email
+    if idempotency_key:
+        existing = conn.execute('SELECT id FROM orders WHERE idempotency_key = ?', (idempotency_key,)).fetchone()
+        if existing:
+            conn.close()
+            print(f"↩️ Duplicate submission of order {existing['id']}")
+            return redirect(url_for('order_confirmation', order_id=existing['id']))
+    
+    # Get product info to check if it's free
     product = conn.execute('SELECT name, price_dzd, type, file_or_key_path FROM products WHERE id = ?', (product_id,)).fetchone()
     
     if not product:
@@ -1443,51 +2866,60 @@ def submit_order():
     if not is_free_product:
         if 'payment_proof' not in request.files or not request.files['payment_proof'].filename:
             conn.close()
-            flash('Payment proof is required to process your order.', 'error')
+            flash('Payment proof is required to process your order.', 'error')
+            return redirect(url_for('buy_product', product_id=product_id))
+        
+        # Checked before saving the proof; the unique index catches concurrent submissions
+        if find_duplicate_transaction(conn, payment_method, transaction_id):
+            conn.close()
+            flash('This transaction ID was already submitted with another order. '
+                  'If you made a new payment, enter its transaction ID.', 'error')
             return redirect(url_for('buy_product', product_id=product_id))
     
-    # Handle file upload for paid products
+    # Handle file upload for paid products (checked and compressed, see save_payment_proof)
     payment_proof_path = None
     if not is_free_product and 'payment_proof' in request.files:
         file = request.files['payment_proof']
         if file and file.filename:
-            filename = str(uuid.uuid4()) + '.' + file.filename.rsplit('.', 1)[1].lower()
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            payment_proof_path = filename
+            try:
+                payment_proof_path = save_payment_proof(file)
+            except PaymentProofError as e:
+                conn.close()
+                flash(str(e), 'error')
+                return redirect(url_for('buy_product', product_id=product_id))
     
     # Get user_id if logged in
     user_id = session.get('user_id')
     
-    # For free products, auto-confirm the order
+    # For free products, auto-confirm the order in the same transaction that creates it
     if is_free_product:
-        confirmation_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor = conn.execute('''INSERT INTO orders 
-                                (product_id, user_id, buyer_name, email, phone, telegram_username, payment_method, 
-                                 payment_proof_path, transaction_id, status, confirmed_at) 
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                             (product_id, user_id, buyer_name, email, phone, telegram_username, 
-                              'free', None, 'FREE-PRODUCT', 'confirmed', confirmation_time))
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.execute('''INSERT INTO orders 
+                                    (product_id, user_id, buyer_name, email, phone, telegram_username, payment_method, 
+                                     payment_proof_path, transaction_id, idempotency_key) 
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                                 (product_id, user_id, buyer_name, email, phone, telegram_username, 
+                                  'free', None, 'FREE-PRODUCT', idempotency_key))
+        except sqlite3.IntegrityError:
+            response = resolve_order_conflict(conn, idempotency_key, 'free', None, product_id)
+            if response is None:
+                raise
+            return response
         order_id = cursor.lastrowid
-        
-        # Update stock for key products
-        if product['type'] == 'key':
-            available_keys = conn.execute('SELECT COUNT(*) FROM product_keys WHERE product_id = ? AND is_used = FALSE',
-                                        (product_id,)).fetchone()[0]
-            conn.execute('UPDATE products SET stock_count = ? WHERE id = ?',
-                        (available_keys, product_id))
-        
+        order_data, reason = transition_order(order_id, 'confirm', f'buyer_{buyer_name}',
+                                              audit_action='free_order_auto_confirmed', conn=conn)
         conn.commit()
-        
-        # Get full order data for delivery
-        order_data = conn.execute('''SELECT o.*, p.name as product_name, p.type, p.file_or_key_path, p.price_dzd
-                                     FROM orders o 
-                                     JOIN products p ON o.product_id = p.id 
-                                     WHERE o.id = ?''', (order_id,)).fetchone()
         conn.close()
+        worker_metrics().inc('dzkeyz_orders_total', event='created')
+        if order_data:
+            worker_metrics().inc('dzkeyz_orders_total', event='confirmed')
         
-        # Log action
-        log_action(order_id, 'free_order_auto_confirmed', f'buyer_{buyer_name}')
+        if not order_data:
+            # Out of keys: the order stays pending for the admin to sort out
+            send_telegram_notification(f"⚠️ Free order #{order_id} could not be auto-confirmed: {reason}")
+            flash('Your order was received. We will send your product as soon as it is available.', 'info')
+            return redirect(url_for('order_confirmation', order_id=order_id))
         
         # Deliver product immediately (includes receipt generation and email)
         deliver_product(order_data)
@@ -1497,18 +2929,26 @@ def submit_order():
         return redirect(url_for('order_confirmation', order_id=order_id))
     
     # For paid products, create pending order
-    cursor = conn.execute('''INSERT INTO orders 
-                            (product_id, user_id, buyer_name, email, phone, telegram_username, payment_method, 
-                             payment_proof_path, transaction_id) 
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                         (product_id, user_id, buyer_name, email, phone, telegram_username, payment_method,
-                          payment_proof_path, transaction_id))
+    try:
+        cursor = conn.execute('''INSERT INTO orders 
+                                (product_id, user_id, buyer_name, email, phone, telegram_username, payment_method, 
+                                 payment_proof_path, transaction_id, idempotency_key) 
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                             (product_id, user_id, buyer_name, email, phone, telegram_username, payment_method,
+                              payment_proof_path, transaction_id, idempotency_key))
+    except sqlite3.IntegrityError:
+        remove_upload(payment_proof_path)
+        response = resolve_order_conflict(conn, idempotency_key, payment_method, transaction_id, product_id)
+        if response is None:
+            raise
+        return response
     order_id = cursor.lastrowid
     conn.commit()
     conn.close()
     
     # Log action
     log_action(order_id, 'order_created', f'buyer_{buyer_name}')
+    worker_metrics().inc('dzkeyz_orders_total', event='created')
     
     # Send Telegram notification
     message = f"""🛒 New Order #{order_id}
@@ -1523,7 +2963,8 @@ Payment: {payment_method.upper()}
 Transaction ID: {transaction_id or 'Not provided'}
 """
     
-    send_telegram_notification(message, order_id, payment_proof_path)
+    send_telegram_notification(message, order_id,
+                               os.path.join(app.config['UPLOAD_FOLDER'], payment_proof_path) if payment_proof_path else None)
     
     # Send order confirmation email to buyer
     if email:
@@ -1547,6 +2988,25 @@ If you have any questions, please contact our support team."""
     print(f"✅ Order {order_id} created successfully, redirecting to confirmation page")
     return redirect(url_for('order_confirmation', order_id=order_id))
 
+def resolve_order_conflict(conn, idempotency_key, payment_method, transaction_id, product_id):
+    """Response for an order insert that hit a unique index: a concurrent copy of the same
+    form won the race, or its transaction ID was just used by another order. None if neither."""
+    conn.rollback()
+    existing = None
+    if idempotency_key:
+        existing = conn.execute('SELECT id FROM orders WHERE idempotency_key = ?', (idempotency_key,)).fetchone()
+    duplicate = find_duplicate_transaction(conn, payment_method, transaction_id)
+    if existing:
+        conn.close()
+        print(f"↩️ Duplicate submission of order {existing['id']}")
+        return redirect(url_for('order_confirmation', order_id=existing['id']))
+    if duplicate:
+        conn.close()
+        flash('This transaction ID was already submitted with another order. '
+              'If you made a new payment, enter its transaction ID.', 'error')
+        return redirect(url_for('buy_product', product_id=product_id))
+    return None
+
 @app.route('/submit_review/<int:product_id>', methods=['POST'])
 @login_required
 def submit_review(product_id):
@@ -1592,11 +3052,17 @@ def submit_review(product_id):
             flash('You have already reviewed this product.', 'warning')
             return redirect(url_for('product_details', product_id=product_id))
 
-        # Insert review
+        # Insert review and update the product's rating summary in the same transaction
         conn.execute('''
             INSERT INTO reviews (user_id, product_id, rating, comment)
             VALUES (?, ?, ?, ?)
         ''', (user_id, product_id, rating, comment))
+        conn.execute(f'''
+            INSERT INTO product_rating_summary (product_id, review_count, rating_sum, stars_{rating})
+            VALUES (?, 1, ?, 1)
+            ON CONFLICT(product_id) DO UPDATE SET review_count = review_count + 1, 
+                rating_sum = rating_sum + excluded.rating_sum, stars_{rating} = stars_{rating} + 1
+        ''', (product_id, rating))
         conn.commit()
         conn.close()
 
@@ -1973,38 +3439,47 @@ def my_orders():
         ORDER BY o.created_at DESC
     ''', (user_id,)).fetchall()
     
-    # Convert to list of dicts and add download tokens for file products
+    # Newest usable download token of each confirmed order. expires_at is stored as local
+    # 'YYYY-MM-DD HH:MM:SS' text, so it is compared as text with the same format.
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    tokens = {row['order_id']: row['token'] for row in conn.execute('''
+        SELECT order_id, token FROM (
+            SELECT t.order_id, t.token, 
+                   ROW_NUMBER() OVER (PARTITION BY t.order_id ORDER BY t.created_at DESC, t.id DESC) AS position
+            FROM orders o
+            JOIN download_tokens t ON t.order_id = o.id
+            WHERE o.user_id = ? AND o.status = 'confirmed' 
+            AND t.download_count < t.max_downloads AND t.expires_at > ?
+        ) WHERE position = 1
+    ''', (user_id, now)).fetchall()}
+    
+    # Keys delivered for confirmed orders
+    keys = {}
+    for row in conn.execute('''
+        SELECT k.used_by_order_id AS order_id, k.key_value FROM orders o
+        JOIN product_keys k ON k.used_by_order_id = o.id
+        WHERE o.user_id = ? AND o.status = 'confirmed'
+        ORDER BY k.id
+    ''', (user_id,)).fetchall():
+        keys.setdefault(row['order_id'], row['key_value'])
+    
+    conn.close()
+    
+    # Convert to list of dicts and add download links and keys
     orders_list = []
     for order in orders:
         order_dict = dict(order)
         
-        # Add download token for confirmed file products
-        if order['status'] == 'confirmed' and order['product_type'] == 'file':
-            token = conn.execute('''
-                SELECT token FROM download_tokens 
-                WHERE order_id = ? AND download_count < max_downloads 
-                AND datetime(expires_at) > datetime('now')
-                ORDER BY created_at DESC LIMIT 1
-            ''', (order['id'],)).fetchone()
-            
-            if token:
-                order_dict['download_token'] = token['token']
-                order_dict['download_url'] = f"{app.config['BASE_URL']}/download/{token['token']}"
-        
-        # Get product key for confirmed key products
-        if order['status'] == 'confirmed' and order['product_type'] == 'key':
-            key = conn.execute('''
-                SELECT key_value FROM product_keys 
-                WHERE used_by_order_id = ?
-            ''', (order['id'],)).fetchone()
-            
-            if key:
-                order_dict['product_key'] = key['key_value']
+        if order['status'] == 'confirmed' and order['product_type'] == 'file' and order['id'] in tokens:
+            token = tokens[order['id']]
+            order_dict['download_token'] = token
+            order_dict['download_url'] = f"{app.config['BASE_URL']}/download/{token}"
+        
+        if order['status'] == 'confirmed' and order['product_type'] == 'key' and order['id'] in keys:
+            order_dict['product_key'] = keys[order['id']]
         
         orders_list.append(order_dict)
     
-    conn.close()
-    
     return render_template('my_orders.html', orders=orders_list)
 
 @app.route('/wishlist')
@@ -2013,35 +3488,42 @@ def wishlist():
     user_id = session.get('user_id')
 
     conn = get_db()
+    # stock_count of key products is kept equal to their unused keys wherever keys are added,
+    # deleted or delivered, so it is read as is
     products = conn.execute('''
         SELECT p.*, w.created_at as wished_at
-        FROM products p
-        JOIN wishlists w ON p.id = w.product_id
+        FROM wishlists w
+        JOIN products p ON p.id = w.product_id
         WHERE w.user_id = ?
         ORDER BY w.created_at DESC
     ''', (user_id,)).fetchall()
 
-    # Process product data (images, etc.)
+    # The card itself is shared by everyone who wished for the product; the remove button
+    # and the date are added per user by the template
     wishlist_items = []
-    for product in products:
+    for product, card_html in zip(products, render_product_cards(conn, products, variant='wishlist')):
         item = dict(product)
-        item['image_urls'] = get_product_images(item['images'])
-        item['main_image'] = item['image_urls'][0] if item['image_urls'] else None
-
-        # Check stock for key products
-        if item['type'] == 'key':
-            available_keys = conn.execute(
-                'SELECT COUNT(*) FROM product_keys WHERE product_id = ? AND is_used = FALSE',
-                (item['id'],)
-            ).fetchone()[0]
-            item['stock_count'] = available_keys
-
+        item['card_html'] = card_html
         wishlist_items.append(item)
-
     conn.close()
 
     return render_template('wishlist.html', products=wishlist_items)
 
+@app.route('/api/wishlist/ids')
+def wishlist_ids():
+    """Product IDs on the current user's wishlist, for marking hearts on product grids"""
+    user_id = session.get('user_id')
+    product_ids = []
+    if user_id:
+        conn = get_db()
+        product_ids = [row['product_id'] for row in conn.execute(
+            'SELECT product_id FROM wishlists WHERE user_id = ?', (user_id,)).fetchall()]
+        conn.close()
+    
+    response = jsonify({'product_ids': product_ids})
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/wishlist/add/<int:product_id>', methods=['POST'])
 @login_required
 def add_to_wishlist(product_id):
@@ -2354,7 +3836,7 @@ def debug_test_resend():
             "text": "Test Email - This is a test email from DZKeyz to verify Resend integration."
         }
         
-        print(f"📧 Testing Resend with API key: {api_key[:10]}...")
+        print("📧 Testing Resend API key")
         
         response = resend.Emails.send(params)
         
@@ -2739,25 +4221,23 @@ def admin_add_landing_page():
     return render_template('admin_add_landing_page.html', products=products)
 
 @app.route('/promo/<slug>')
+@cached_page
 def landing_page(slug):
     """Display custom landing page"""
     try:
         conn = get_db()
-        page = conn.execute('SELECT * FROM landing_pages WHERE slug = ? AND is_active = TRUE', (slug,)).fetchone()
+        landing_page = get_landing_pages(conn).get(slug)
         
-        if not page:
+        if not landing_page:
+            conn.close()
             flash('Page not found.', 'error')
             return redirect(url_for('index'))
         
-        # Get products for this landing page
-        products = conn.execute('''SELECT p.*, lpp.display_order
-                                  FROM products p
-                                  JOIN landing_page_products lpp ON p.id = lpp.product_id
-                                  WHERE lpp.landing_page_id = ? AND p.is_visible = TRUE
-                                  ORDER BY lpp.display_order''', (page['id'],)).fetchall()
+        page, products = landing_page
+        product_cards = render_product_cards(conn, products)
         
         conn.close()
-        return render_template('landing_page.html', page=page, products=products)
+        return render_template('landing_page.html', page=page, products=products, product_cards=product_cards)
         
     except Exception as e:
         print(f"❌ Error loading landing page: {e}")
@@ -2858,15 +4338,31 @@ def admin_branding():
     
     return render_template('admin_branding.html', settings=settings)
 
+# Store settings, reloaded when the branding version moves (see init_db)
+_branding_cache = {'version': None, 'settings': {}}
+
+def get_branding_settings():
+    global _branding_cache
+    version = get_cache_versions().get('branding', 0)
+    cached = _branding_cache
+    if cached['version'] == version:
+        record_cache_lookup('branding', True)
+        return cached['settings']
+    record_cache_lookup('branding', False)
+    
+    conn = get_db()
+    settings_raw = conn.execute('SELECT setting_key, setting_value FROM store_settings').fetchall()
+    conn.close()
+    
+    settings = {row['setting_key']: row['setting_value'] for row in settings_raw}
+    _branding_cache = {'version': version, 'settings': settings}
+    return settings
+
 @app.context_processor
 def inject_branding_settings():
     """Make branding settings available to all templates"""
     try:
-        conn = get_db()
-        settings_raw = conn.execute('SELECT setting_key, setting_value FROM store_settings').fetchall()
-        conn.close()
-        
-        settings = {row['setting_key']: row['setting_value'] for row in settings_raw}
+        settings = get_branding_settings()
         
         return {
             'branding': settings,
@@ -3214,6 +4710,7 @@ def branding_css():
 @admin_required
 def generate_product_description():
     """Generate AI product description using OpenAI"""
+    import requests
     try:
         data = request.get_json()
         product_name = data.get('name', '').strip()
@@ -3330,6 +4827,7 @@ def google_login():
 @app.route('/auth/google/callback')
 def google_callback():
     """Handle Google OAuth callback"""
+    import requests
     try:
         # Verify state
         if request.args.get('state') != session.get('oauth_state'):
@@ -3406,6 +4904,7 @@ def discord_login():
 @app.route('/auth/discord/callback')
 def discord_callback():
     """Handle Discord OAuth callback"""
+    import requests
     try:
         # Verify state
         if request.args.get('state') != session.get('oauth_state'):
@@ -3924,6 +5423,7 @@ def delete_product(product_id):
     if product:
         # Delete associated keys
         conn.execute('DELETE FROM product_keys WHERE product_id = ?', (product_id,))
+        conn.execute('DELETE FROM related_products WHERE product_id = ? OR related_id = ?', (product_id, product_id))
         
         # Delete product file if it exists
         if product['type'] == 'file' and product['file_or_key_path'] and os.path.exists(product['file_or_key_path']):
@@ -4111,52 +5611,122 @@ def delete_all_orders():
     
     return redirect(url_for('admin_dashboard'))
 
+# Order state machine: every status change (the admin page, bulk actions, the Telegram
+# buttons and free-product auto-confirm) goes through transition_orders, which checks the
+# current status, allocates keys, adjusts stock and writes the audit entry in one transaction.
+ORDER_TRANSITIONS = {
+    'confirm': {'from': 'pending', 'to': 'confirmed', 'audit_action': 'order_confirmed'},
+    'reject': {'from': 'pending', 'to': 'rejected', 'audit_action': 'order_rejected'},
+}
+
+def transition_orders(order_ids, action, actor, note=None, audit_action=None, conn=None):
+    """Confirm or reject pending orders and return (orders, results).
+    
+    orders are the changed orders with their product columns, ready for deliver_product or
+    notify_buyer_rejection. results maps every requested id to {'order_id', 'result', 'reason'};
+    orders that aren't pending, or key orders with no key left, are skipped and stay as they are.
+    Pass conn (with a transaction already begun) to make the change part of the caller's
+    transaction; the caller then commits and records dzkeyz_orders_total for the changed orders.
+    """
+    transition = ORDER_TRANSITIONS[action]
+    order_ids = list(dict.fromkeys(order_ids))
+    results = {order_id: {'order_id': order_id, 'result': 'skipped', 'reason': 'not found'} for order_id in order_ids}
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db()
+    
+    try:
+        if own_conn:
+            # Take the write lock first so no other request moves these orders or takes these keys meanwhile
+            conn.execute('BEGIN IMMEDIATE')
+        placeholders = ','.join('?' * len(order_ids))
+        orders = conn.execute(f'''SELECT o.id, o.status, o.product_id, p.type
+                                  FROM orders o JOIN products p ON o.product_id = p.id
+                                  WHERE o.id IN ({placeholders})
+                                  ORDER BY o.id''', order_ids).fetchall()
+        
+        pending = []
+        for order in orders:
+            if order['status'] != transition['from']:
+                results[order['id']]['reason'] = f"already {order['status']}"
+            else:
+                pending.append(order)
+        
+        done = []
+        if action == 'confirm':
+            # Allocate keys per product, oldest first like get_available_key; orders left without
+            # a key stay pending. deliver_product later picks up the key allocated here.
+            key_orders = {}
+            file_orders = {}
+            for order in pending:
+                (key_orders if order['type'] == 'key' else file_orders).setdefault(order['product_id'], []).append(order)
+            
+            allocations = []
+            for product_id, product_orders in key_orders.items():
+                keys = conn.execute('''SELECT id FROM product_keys
+                                        WHERE product_id = ? AND is_used = FALSE
+                                        ORDER BY created_at ASC LIMIT ?''', (product_id, len(product_orders))).fetchall()
+                for order, key in zip(product_orders, keys):
+                    allocations.append((order['id'], key['id']))
+                    done.append(order['id'])
+                for order in product_orders[len(keys):]:
+                    results[order['id']]['reason'] = 'no keys left'
+                # stock_count of key products is the number of unused keys
+                conn.execute('UPDATE products SET stock_count = MAX(stock_count - ?, 0) WHERE id = ?', (len(keys), product_id))
+            conn.executemany('''UPDATE product_keys SET is_used = TRUE, used_by_order_id = ?, used_at = CURRENT_TIMESTAMP
+                                  WHERE id = ?''', allocations)
+            
+            for product_id, product_orders in file_orders.items():
+                conn.execute('UPDATE products SET stock_count = stock_count - ? WHERE id = ?', (len(product_orders), product_id))
+                done.extend(order['id'] for order in product_orders)
+            
+            confirmation_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            conn.executemany("UPDATE orders SET status = ?, confirmed_at = ? WHERE id = ?",
+                             [(transition['to'], confirmation_time, order_id) for order_id in done])
+        else:
+            done = [order['id'] for order in pending]
+            conn.executemany('UPDATE orders SET status = ? WHERE id = ?', [(transition['to'], order_id) for order_id in done])
+        
+        conn.executemany('INSERT INTO audit_log (order_id, action, actor, note) VALUES (?, ?, ?, ?)',
+                         [(order_id, audit_action or transition['audit_action'], actor, note) for order_id in done])
+        
+        changed = []
+        if done:
+            changed = conn.execute(f'''SELECT o.*, p.name as product_name, p.type, p.file_or_key_path, p.price_dzd
+                                       FROM orders o JOIN products p ON o.product_id = p.id
+                                       WHERE o.id IN ({','.join('?' * len(done))})
+                                       ORDER BY o.id''', done).fetchall()
+        if own_conn:
+            conn.commit()
+    except Exception:
+        if own_conn:
+            conn.rollback()
+        raise
+    finally:
+        if own_conn:
+            conn.close()
+    
+    for order_id in done:
+        results[order_id] = {'order_id': order_id, 'result': transition['to'], 'reason': None}
+        if own_conn:
+            worker_metrics().inc('dzkeyz_orders_total', event=transition['to'])
+    return changed, results
+
+def transition_order(order_id, action, actor, note=None, audit_action=None, conn=None):
+    """transition_orders for one order: returns (order, reason), order being None when it was skipped"""
+    orders, results = transition_orders([order_id], action, actor, note=note, audit_action=audit_action, conn=conn)
+    return (orders[0] if orders else None), results[order_id]['reason']
+
 @app.route('/admin/confirm_order/<int:order_id>')
 @admin_required
 def confirm_order(order_id):
-    conn = get_db()
-    
-    # Get order and product info
-    order = conn.execute('''SELECT o.*, p.name as product_name, p.type, p.file_or_key_path, p.stock_count, p.price_dzd
-                           FROM orders o 
-                           JOIN products p ON o.product_id = p.id 
-                           WHERE o.id = ?''', (order_id,)).fetchone()
-    
-    if not order or order['status'] != 'pending':
-        flash('Order not found or already processed', 'error')
+    order, reason = transition_order(order_id, 'confirm', 'admin')
+    if not order:
+        flash(f'Order not confirmed: {reason}', 'error')
         return redirect(url_for('admin_dashboard'))
     
-    # Update order status
-    confirmation_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    conn.execute('UPDATE orders SET status = "confirmed", confirmed_at = ? WHERE id = ?',
-                (confirmation_time, order_id))
-    
-    # Decrease stock (for key products, this is handled in get_available_key)
-    if order['type'] != 'key':
-        conn.execute('UPDATE products SET stock_count = stock_count - 1 WHERE id = ?',
-                    (order['product_id'],))
-    else:
-        # For key products, update stock to reflect available unused keys
-        available_keys = conn.execute('SELECT COUNT(*) FROM product_keys WHERE product_id = ? AND is_used = FALSE',
-                                    (order['product_id'],)).fetchone()[0]
-        conn.execute('UPDATE products SET stock_count = ? WHERE id = ?',
-                    (available_keys, order['product_id']))
-    
-    conn.commit()
-    
-    # Get updated order data for receipt generation and delivery
-    updated_order = conn.execute('''SELECT o.*, p.name as product_name, p.type, p.file_or_key_path, p.price_dzd
-                                   FROM orders o 
-                                   JOIN products p ON o.product_id = p.id 
-                                   WHERE o.id = ?''', (order_id,)).fetchone()
-    
-    conn.close()
-    
-    # Log action
-    log_action(order_id, 'order_confirmed', 'admin')
-    
     # Send product to buyer (receipt will be generated in deliver_product)
-    deliver_product(updated_order)  # Use updated_order instead of order
+    deliver_product(order)
     
     flash('Order confirmed, product delivered, and receipt generated', 'success')
     return redirect(url_for('admin_dashboard'))
@@ -4164,29 +5734,89 @@ def confirm_order(order_id):
 @app.route('/admin/reject_order/<int:order_id>')
 @admin_required
 def reject_order(order_id):
-    conn = get_db()
+    order, reason = transition_order(order_id, 'reject', 'admin')
+    if not order:
+        flash(f'Order not rejected: {reason}', 'error')
+        return redirect(url_for('admin_dashboard'))
     
-    # Get order info before rejecting
-    order = conn.execute('''SELECT o.*, p.name as product_name
-                           FROM orders o 
-                           JOIN products p ON o.product_id = p.id 
-                           WHERE o.id = ?''', (order_id,)).fetchone()
+    notify_buyer_rejection(order)
     
-    conn.execute('UPDATE orders SET status = "rejected" WHERE id = ?', (order_id,))
-    conn.commit()
-    conn.close()
+    flash('Order rejected and buyer notified', 'success')
+    return redirect(url_for('admin_dashboard'))
+
+BULK_ORDER_LIMIT = 500
+
+@app.route('/admin/orders/bulk', methods=['POST'])
+@admin_required
+def admin_bulk_orders():
+    """Confirm or reject many pending orders in one transaction.
     
-    # Notify buyer if order exists
-    if order:
-        notify_buyer_rejection(order)
+    Keys are allocated for all confirmed key orders at once, and deliveries (or rejection
+    notices) are queued for the background delivery worker rather than sent inline. Returns
+    a per-order summary as JSON when asked for it, otherwise flashes it.
+    """
+    wants_json = request.is_json or request.accept_mimetypes.best == 'application/json'
+    if request.is_json:
+        payload = request.get_json(silent=True)
+        payload = payload if isinstance(payload, dict) else {}
+        action = payload.get('action')
+        raw_ids = payload.get('order_ids')
+    else:
+        action = request.form.get('action')
+        raw_ids = request.form.getlist('order_ids')
     
-    log_action(order_id, 'order_rejected', 'admin')
+    order_ids = None
+    if isinstance(raw_ids, list):
+        try:
+            order_ids = list(dict.fromkeys(int(order_id) for order_id in raw_ids))
+        except (TypeError, ValueError):
+            pass
+    if action not in ('confirm', 'reject') or not order_ids or len(order_ids) > BULK_ORDER_LIMIT:
+        message = f'Choose confirm or reject and between 1 and {BULK_ORDER_LIMIT} orders.'
+        if wants_json:
+            return jsonify({'error': message}), 400
+        flash(message, 'error')
+        return redirect(url_for('admin_orders'))
     
-    flash('Order rejected and buyer notified', 'success')
-    return redirect(url_for('admin_dashboard'))
+    conn = get_db()
+    try:
+        # The queued deliveries are committed together with the status changes
+        conn.execute('BEGIN IMMEDIATE')
+        orders, results = transition_orders(order_ids, action, 'admin', note='bulk', conn=conn)
+        queue_action = 'deliver' if action == 'confirm' else 'notify_rejection'
+        conn.executemany('INSERT INTO delivery_queue (order_id, action) VALUES (?, ?)',
+                         [(order['id'], queue_action) for order in orders])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    done = [order['id'] for order in orders]
+    result = ORDER_TRANSITIONS[action]['to']
+    for order_id in done:
+        worker_metrics().inc('dzkeyz_orders_total', event=result)
+    if done:
+        wake_delivery_worker()
+    
+    summary = {'action': action, result: len(done), 'skipped': len(order_ids) - len(done),
+               'results': [results[order_id] for order_id in order_ids]}
+    print(f"📦 Bulk {action}: {len(done)} {result}, {summary['skipped']} skipped")
+    if wants_json:
+        return jsonify(summary)
+    
+    skipped = [f"#{r['order_id']} ({r['reason']})" for r in summary['results'] if r['result'] == 'skipped']
+    follow_up = 'their products are being delivered' if action == 'confirm' else 'the buyers are being notified'
+    flash(f"{len(done)} orders {result}; {follow_up}." if done else f'No orders {result}.',
+          'success' if done else 'warning')
+    if skipped:
+        flash(f"Skipped {len(skipped)}: {', '.join(skipped[:20])}{' ...' if len(skipped) > 20 else ''}", 'warning')
+    return redirect(url_for('admin_orders'))
 
 def send_telegram_message_to_user(telegram_identifier, message):
     """Send a direct message to a user via Telegram"""
+    import requests
     bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
     if not bot_token or not telegram_identifier:
         print(f"❌ Missing bot token or telegram identifier")
@@ -4211,13 +5841,16 @@ def send_telegram_message_to_user(telegram_identifier, message):
             chat_formats.append(telegram_identifier)
         
         # Try each format
-        for chat_id in chat_formats:
+        for attempt, chat_id in enumerate(chat_formats):
+            if attempt:
+                worker_metrics().inc('dzkeyz_telegram_retries_total', reason='chat_id_format')
             try:
                 data = {
                     "chat_id": chat_id,
                     "text": message
                 }
-                response = requests.post(url, json=data)
+                with timed_external_call('telegram'):
+                    response = requests.post(url, json=data)
                 
                 if response.status_code == 200:
                     print(f"✅ Message sent successfully to {chat_id}")
@@ -4238,10 +5871,14 @@ def send_telegram_message_to_user(telegram_identifier, message):
         print(f"❌ Failed to send message to user {telegram_identifier}: {e}")
         return False
 
-def notify_buyer_rejection(order):
-    """Notify buyer that their order was rejected"""
+def notify_buyer_rejection(order, skip_channels=()):
+    """Notify buyer that their order was rejected. Returns the channels ('email', 'telegram')
+    that failed, empty when every notice went out; skip_channels were already sent"""
+    failed = []
     # Send professional rejection email
-    if order['email']:
+    if 'email' in skip_channels:
+        pass
+    elif order['email']:
         print(f"📧 Sending rejection email to {order['email']}")
         store_name = os.getenv('STORE_NAME', 'Digital Store')
         email_subject = f"Order Update - {store_name}"
@@ -4264,12 +5901,15 @@ If you believe this is an error, please contact our support team with your order
 
 We apologize for any inconvenience caused."""
         
-        send_email(order['email'], email_subject, email_body, order['buyer_name'], "order_rejection")
+        if not send_email(order['email'], email_subject, email_body, order['buyer_name'], "order_rejection"):
+            failed.append('email')
     else:
         print("📧 No email address provided for rejection notification")
     
     # Send Telegram notification if username provided
-    if order['telegram_username']:
+    if 'telegram' in skip_channels:
+        pass
+    elif order['telegram_username']:
         message = f"""❌ Order #{order['id']} Rejected
 
 Unfortunately, your payment for "{order['product_name']}" could not be verified.
@@ -4278,14 +5918,24 @@ Please contact support if you believe this is an error.
 Order ID: #{order['id']}
 Buyer: {order['buyer_name']}"""
         
-        send_telegram_message_to_user(order['telegram_username'], message)
+        if not send_telegram_message_to_user(order['telegram_username'], message):
+            failed.append('telegram')
     else:
         print("📱 No Telegram username provided for rejection notification")
+    
+    return failed
 
 def get_available_key(product_id, order_id):
-    """Get an available key for the product and mark it as used"""
+    """Get the key already allocated to the order, or an available key for the product marked as used"""
     conn = get_db()
     
+    # Bulk confirmation allocates keys up front, and a retried delivery must not take a second key
+    allocated = conn.execute('SELECT key_value FROM product_keys WHERE used_by_order_id = ? AND product_id = ? LIMIT 1',
+                             (order_id, product_id)).fetchone()
+    if allocated:
+        conn.close()
+        return allocated['key_value']
+    
     # Get an unused key
     key_row = conn.execute('''SELECT id, key_value FROM product_keys 
                              WHERE product_id = ? AND is_used = FALSE 
@@ -4310,30 +5960,158 @@ def get_available_key(product_id, order_id):
     conn.close()
     return None
 
-def cleanup_expired_tokens():
-    """Clean up expired download tokens (optional maintenance)"""
-    from datetime import datetime
+def cleanup_expired_tokens(batch_size=None):
+    """Delete expired download tokens in batches and return how many rows were removed"""
+    batch_size = batch_size or app.config['TOKEN_CLEANUP_BATCH_SIZE']
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
     conn = get_db()
-    deleted = conn.execute('''DELETE FROM download_tokens 
-                             WHERE expires_at < ?''', 
-                          (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),)).rowcount
-    conn.commit()
+    deleted = 0
+    batches = 0
+    while True:
+        # expires_at is stored as 'YYYY-MM-DD HH:MM:SS', so the text comparison uses the index
+        batch = conn.execute('''DELETE FROM download_tokens 
+                                WHERE id IN (SELECT id FROM download_tokens 
+                                             WHERE expires_at < ? LIMIT ?)''', 
+                             (now, batch_size)).rowcount
+        conn.commit()
+        deleted += batch
+        batches += 1
+        if batch < batch_size:
+            break
     conn.close()
     
     if deleted > 0:
-        print(f"🧹 Cleaned up {deleted} expired download tokens")
+        print(f"🧹 Cleaned up {deleted} expired download tokens in {batches} batches")
     
     return deleted
 
+# Related products: each product keeps its RELATED_PRODUCTS_STORED best neighbours. Each customer
+# who bought both products counts most, then shared tags, category and type. Besides
+# co-purchases, candidates come from the best sellers of the product's category and tags, which
+# keeps the rebuild linear in the catalog size.
+# The scoring is CPU-bound Python, so the maintenance thread runs it in chunks of
+# RELATED_REBUILD_CHUNK products and sleeps RELATED_REBUILD_PAUSE seconds after each one,
+# letting the worker's request threads have the GIL. `flask rebuild-related` runs flat out.
+RELATED_PRODUCTS_STORED = 12
+RELATED_CANDIDATE_POOL = 50
+RELATED_REBUILD_CHUNK = 200
+RELATED_REBUILD_PAUSE = 0.05
+
+def rebuild_related_products(pause=0):
+    """Recompute the related_products table and return how many rows were written.
+    
+    pause: seconds to sleep after every RELATED_REBUILD_CHUNK products (and write batch)
+    """
+    import heapq
+    import math
+    from collections import defaultdict
+    
+    conn = get_db()
+    product_rows = conn.execute('SELECT id, category_id, type FROM products').fetchall()
+    tags = defaultdict(set)
+    for row in conn.execute('SELECT product_id, tag_id FROM product_tags').fetchall():
+        tags[row['product_id']].add(row['tag_id'])
+    sales = {row['product_id']: row['sales'] for row in conn.execute('''
+        SELECT product_id, COUNT(*) AS sales FROM orders WHERE status = 'confirmed' GROUP BY product_id''').fetchall()}
+    
+    # Distinct customers (account, or email for guest checkouts) who bought both products
+    co_purchases = defaultdict(dict)
+    for row in conn.execute('''
+        WITH buyers AS (
+            SELECT DISTINCT product_id, COALESCE(CAST(user_id AS TEXT), LOWER(email)) AS buyer
+            FROM orders WHERE status = 'confirmed'
+        )
+        SELECT a.product_id AS product_id, b.product_id AS related_id, COUNT(*) AS buyers
+        FROM buyers a JOIN buyers b ON a.buyer = b.buyer AND a.product_id != b.product_id
+        GROUP BY a.product_id, b.product_id''').fetchall():
+        co_purchases[row['product_id']][row['related_id']] = row['buyers']
+    
+    # (category, type, tags, popularity bonus) per product. A product without a category gets a
+    # placeholder that matches no other product.
+    no_tags = frozenset()
+    info = {row['id']: (row['category_id'] if row['category_id'] is not None else object(), row['type'],
+                        frozenset(tags.get(row['id'], no_tags)), 0.1 * math.log1p(sales.get(row['id'], 0)))
+            for row in product_rows}
+    
+    # Candidate pools: best sellers (then newest) that can be bought, per category and per tag
+    buyable = conn.execute('''SELECT id, category_id FROM products 
+                              WHERE is_visible = TRUE AND stock_count > 0 
+                              ORDER BY created_at DESC''').fetchall()
+    buyable.sort(key=lambda row: sales.get(row['id'], 0), reverse=True)
+    category_pool = defaultdict(list)
+    tag_pool = defaultdict(list)
+    for row in buyable:
+        if len(category_pool[row['category_id']]) < RELATED_CANDIDATE_POOL:
+            category_pool[row['category_id']].append(row['id'])
+        for tag_id in tags.get(row['id'], ()):
+            if len(tag_pool[tag_id]) < RELATED_CANDIDATE_POOL:
+                tag_pool[tag_id].append(row['id'])
+    
+    def similarity(product, related_id):
+        category_id, product_type, product_tags, _ = product
+        related_category, related_type, related_tags, popularity = info[related_id]
+        return (len(product_tags & related_tags) + (related_category == category_id)
+                + 0.5 * (related_type == product_type) + popularity)
+    
+    # Products with the same category, type and tags share their most similar candidates
+    similar_by_signature = {}
+    related = {}
+    for index, (product_id, product) in enumerate(info.items(), 1):
+        if pause and index % RELATED_REBUILD_CHUNK == 0:
+            time.sleep(pause)
+        signature = product[:3]
+        similar = similar_by_signature.get(signature)
+        if similar is None:
+            category_id, _, product_tags, _ = product
+            candidates = set(category_pool.get(category_id, ()))
+            for tag_id in product_tags:
+                candidates.update(tag_pool[tag_id])
+            # One extra so the product itself can be dropped
+            similar = heapq.nlargest(RELATED_PRODUCTS_STORED + 1,
+                                     ((similarity(product, related_id), related_id) for related_id in candidates))
+            similar_by_signature[signature] = similar
+        
+        scores = {related_id: score for score, related_id in similar if related_id != product_id}
+        bought_with = co_purchases.get(product_id, {})
+        for related_id, buyers in bought_with.items():
+            if related_id in info:
+                scores[related_id] = 3 * buyers + similarity(product, related_id)
+        
+        related[product_id] = [
+            (product_id, related_id, round(score, 4), 'co_purchase' if related_id in bought_with else 'similar')
+            for related_id, score in heapq.nlargest(RELATED_PRODUCTS_STORED, scores.items(), key=lambda item: item[1])
+        ]
+    
+    # Replace the rows a batch of products at a time: each product's list changes atomically and
+    # the write lock is never held for long
+    batch_size = 500
+    product_ids = list(related)
+    written = 0
+    for start in range(0, len(product_ids), batch_size):
+        batch = product_ids[start:start + batch_size]
+        rows = [row for product_id in batch for row in related[product_id]]
+        conn.execute(f"DELETE FROM related_products WHERE product_id IN ({','.join('?' * len(batch))})", batch)
+        conn.executemany('INSERT INTO related_products (product_id, related_id, score, reason) VALUES (?, ?, ?, ?)', rows)
+        conn.commit()
+        written += len(rows)
+        if pause:
+            time.sleep(pause)
+    conn.close()
+    
+    print(f"🔗 Rebuilt related products: {written} rows for {len(related)} products")
+    return written
+
+@app.cli.command('rebuild-related')
+def rebuild_related_command():
+    """Recompute related products from orders, categories and tags"""
+    rebuild_related_products()
+
 def generate_download_token(order_id, product_id, file_path):
     """Generate a secure download token for file products"""
     import uuid
     from datetime import datetime, timedelta
     
-    # Clean up expired tokens (optional)
-    cleanup_expired_tokens()
-    
     token = str(uuid.uuid4())
     expires_at = datetime.now() + timedelta(hours=48)  # 48 hours expiry
     
@@ -4348,9 +6126,95 @@ def generate_download_token(order_id, product_id, file_path):
     print(f"✅ Generated download token for order #{order_id}: {token}")
     return token
 
-def deliver_product(order):
-    """Deliver product to buyer via Telegram and email"""
+def get_download_token(order_id, product_id, file_path):
+    """The order's unexpired download token with downloads left, or a new one, so a
+    retried delivery sends the same link"""
+    conn = get_db()
+    row = conn.execute('''SELECT token FROM download_tokens
+                          WHERE order_id = ? AND product_id = ? AND file_path = ?
+                            AND expires_at > ? AND download_count < max_downloads
+                          ORDER BY id DESC LIMIT 1''',
+                       (order_id, product_id, file_path, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))).fetchone()
+    conn.close()
+    if row:
+        return row['token']
+    return generate_download_token(order_id, product_id, file_path)
+
+# Periodic maintenance tasks, run from a background thread in each worker.
+# Runs are claimed through the maintenance_runs table so only one worker does the work.
+MAINTENANCE_TASKS = {
+    'cleanup_expired_tokens': cleanup_expired_tokens,
+    'rebuild_related_products': lambda: rebuild_related_products(pause=RELATED_REBUILD_PAUSE),
+}
+
+_maintenance_thread_pid = None
+_maintenance_lock = threading.Lock()
+
+def claim_maintenance_task(task, interval):
+    """Atomically mark a task as started if it hasn't run within the interval"""
+    now = time.time()
+    conn = get_db()
+    conn.execute('INSERT OR IGNORE INTO maintenance_runs (task, last_run_at) VALUES (?, 0)', (task,))
+    claimed = conn.execute('''UPDATE maintenance_runs SET last_run_at = ?, updated_at = CURRENT_TIMESTAMP 
+                             WHERE task = ? AND last_run_at <= ?''', 
+                          (now, task, now - interval)).rowcount
+    conn.commit()
+    conn.close()
+    return claimed == 1
+
+def run_maintenance(force=False):
+    """Run every due maintenance task and return {task: result}"""
+    interval = app.config['MAINTENANCE_INTERVAL']
+    results = {}
+    for task, func in MAINTENANCE_TASKS.items():
+        if not force and not claim_maintenance_task(task, interval * 0.9):
+            continue
+        try:
+            results[task] = func()
+        except Exception as e:
+            print(f"⚠️ Maintenance task {task} failed: {e}")
+            results[task] = f"error: {e}"
+        
+        conn = get_db()
+        conn.execute('UPDATE maintenance_runs SET last_result = ? WHERE task = ?', (json.dumps(results[task]), task))
+        conn.commit()
+        conn.close()
+    return results
+
+def _maintenance_loop(interval):
+    # Stagger the first run so workers that boot together don't all wake at once
+    time.sleep(min(60, interval) * random.uniform(0.5, 1.0))
+    while True:
+        try:
+            run_maintenance()
+        except Exception as e:
+            print(f"⚠️ Maintenance run failed: {e}")
+        time.sleep(interval)
+
+def start_maintenance_scheduler():
+    """Start the maintenance thread once per worker process"""
+    global _maintenance_thread_pid
+    interval = app.config['MAINTENANCE_INTERVAL']
+    if interval <= 0 or _maintenance_thread_pid == os.getpid():
+        return
+    
+    with _maintenance_lock:
+        # Threads don't survive a fork, so track the pid rather than a flag
+        if _maintenance_thread_pid == os.getpid():
+            return
+        _maintenance_thread_pid = os.getpid()
+        threading.Thread(target=_maintenance_loop, args=(interval,), name='maintenance', daemon=True).start()
+
+@app.before_request
+def ensure_maintenance_scheduler():
+    start_maintenance_scheduler()
+
+def deliver_product(order, skip_channels=()):
+    """Deliver product to buyer via Telegram and email. Returns the channels ('email',
+    'telegram') that failed, empty when the buyer got everything. skip_channels ('email',
+    'telegram', 'admin') were sent by an earlier attempt and aren't sent again."""
     print(f"🔄 Delivering product for order #{order['id']}")
+    failed = []
     
     # Get product key once if it's a key product
     product_key = None
@@ -4383,7 +6247,7 @@ Thank you for your purchase!"""
         
         # Generate secure download token
         if order['file_or_key_path'] and os.path.exists(order['file_or_key_path']):
-            download_token = generate_download_token(order['id'], order['product_id'], order['file_or_key_path'])
+            download_token = get_download_token(order['id'], order['product_id'], order['file_or_key_path'])
             
             # Get the base URL from app config
             base_url = app.config['BASE_URL']
@@ -4411,14 +6275,19 @@ Thank you for your purchase!"""
             key_info = "⚠️ File delivery issue - please contact support immediately."
     
     # Send via Telegram if username provided
-    if order['telegram_username']:
+    if 'telegram' in skip_channels:
+        pass
+    elif order['telegram_username']:
         print(f"� Sendding Telegram message to @{order['telegram_username']}")
-        send_telegram_message_to_user(order['telegram_username'], telegram_message)
+        if not send_telegram_message_to_user(order['telegram_username'], telegram_message):
+            failed.append('telegram')
     else:
         print("📱 No Telegram username provided")
     
     # Send confirmation email with receipt attachment
-    if order['email']:
+    if 'email' in skip_channels:
+        pass
+    elif order['email']:
         print(f"📧 Sending confirmation email to {order['email']}")
         store_name = os.getenv('STORE_NAME', 'Digital Store')
         email_subject = f"Your Order Confirmation from {store_name}"
@@ -4456,18 +6325,123 @@ Thank you for choosing {store_name}!"""
                 print(f"📄 Receipt generated and saved: {receipt_path}")
         
         # Send email with receipt attachment
-        send_email(order['email'], email_subject, email_body, order['buyer_name'], "order_confirmation", receipt_path)
+        if not send_email(order['email'], email_subject, email_body, order['buyer_name'], "order_confirmation", receipt_path):
+            failed.append('email')
     else:
         print("📧 No email address provided")
     
     # Send notification to admin about delivery
-    admin_message = f"✅ Product delivered to {order['buyer_name']} for order #{order['id']}"
-    send_telegram_notification(admin_message)
+    if 'admin' not in skip_channels:
+        admin_message = f"✅ Product delivered to {order['buyer_name']} for order #{order['id']}"
+        send_telegram_notification(admin_message)
     print(f"✅ Product delivery completed for order #{order['id']}")
+    return failed
+
+# Delivery queue: sending a delivery means a PDF, an email and Telegram calls, so bulk actions
+# queue them and a background thread in each worker sends them one at a time. Rows are claimed
+# with a single UPDATE, so workers never send the same delivery twice; a claim older than
+# DELIVERY_CLAIM_TIMEOUT (a worker died mid-send) is picked up again. A failed send is retried
+# no sooner than DELIVERY_RETRY_DELAY seconds later, and only over the channels that failed:
+# sent_channels remembers the ones that already went out.
+DELIVERY_CLAIM_TIMEOUT = 600
+DELIVERY_RETRY_DELAY = 60
+_delivery_thread_pid = None
+_delivery_lock = threading.Lock()
+_delivery_wakeup = threading.Event()
+
+def claim_delivery(conn):
+    """Mark the next pending delivery as processing and return it, or None"""
+    now = time.time()
+    row = conn.execute('''UPDATE delivery_queue SET status = 'processing', attempts = attempts + 1, claimed_at = ?
+                          WHERE id = (SELECT id FROM delivery_queue
+                                      WHERE (status = 'pending' AND (claimed_at IS NULL OR claimed_at < ?))
+                                         OR (status = 'processing' AND claimed_at < ?)
+                                      ORDER BY id LIMIT 1)
+                          RETURNING id, order_id, action, attempts, sent_channels''',
+                       (now, now - DELIVERY_RETRY_DELAY, now - DELIVERY_CLAIM_TIMEOUT)).fetchone()
+    conn.commit()
+    return row
+
+def process_delivery_queue(limit=None):
+    """Send queued deliveries until the queue is empty (or limit is reached); returns how many were handled"""
+    handled = 0
+    conn = get_db()
+    try:
+        while limit is None or handled < limit:
+            job = claim_delivery(conn)
+            if not job:
+                break
+            handled += 1
+            sent = set(job['sent_channels'].split(',')) if job['sent_channels'] else set()
+            try:
+                order = conn.execute('''SELECT o.*, p.name as product_name, p.type, p.file_or_key_path, p.price_dzd
+                                        FROM orders o
+                                        JOIN products p ON o.product_id = p.id
+                                        WHERE o.id = ?''', (job['order_id'],)).fetchone()
+                if order:
+                    with app.app_context():
+                        if job['action'] == 'deliver':
+                            failed = deliver_product(order, skip_channels=sent)
+                        else:
+                            failed = notify_buyer_rejection(order, skip_channels=sent)
+                    # Everything that didn't fail went out (or has nowhere to go) and isn't retried
+                    sent |= {'email', 'telegram', 'admin'} - set(failed)
+                    # The senders report failures instead of raising; retry like an exception
+                    if failed:
+                        raise RuntimeError(f"{' and '.join(failed)} sending failed")
+                conn.execute("""UPDATE delivery_queue SET status = 'done', processed_at = CURRENT_TIMESTAMP, sent_channels = ?
+                                WHERE id = ?""", (','.join(sorted(sent)) or None, job['id']))
+            except Exception as e:
+                print(f"❌ Delivery for order #{job['order_id']} failed (attempt {job['attempts']}): {e}")
+                status = 'failed' if job['attempts'] >= app.config['DELIVERY_MAX_ATTEMPTS'] else 'pending'
+                conn.execute('UPDATE delivery_queue SET status = ?, last_error = ?, sent_channels = ? WHERE id = ?',
+                             (status, str(e)[:500], ','.join(sorted(sent)) or None, job['id']))
+            conn.commit()
+    finally:
+        conn.close()
+    return handled
+
+def _delivery_loop(interval):
+    while True:
+        _delivery_wakeup.wait(interval)
+        _delivery_wakeup.clear()
+        try:
+            process_delivery_queue()
+        except Exception as e:
+            print(f"⚠️ Delivery queue run failed: {e}")
+
+def start_delivery_worker():
+    """Start the delivery thread once per worker process"""
+    global _delivery_thread_pid
+    interval = app.config['DELIVERY_POLL_INTERVAL']
+    if interval <= 0 or _delivery_thread_pid == os.getpid():
+        return
+    
+    with _delivery_lock:
+        # Threads don't survive a fork, so track the pid rather than a flag
+        if _delivery_thread_pid == os.getpid():
+            return
+        _delivery_thread_pid = os.getpid()
+        threading.Thread(target=_delivery_loop, args=(interval,), name='deliveries', daemon=True).start()
+
+def wake_delivery_worker():
+    start_delivery_worker()
+    _delivery_wakeup.set()
+
+@app.before_request
+def ensure_delivery_worker():
+    start_delivery_worker()
+
+@app.cli.command('process-deliveries')
+def process_deliveries_command():
+    """Send every queued delivery and rejection notice now"""
+    handled = process_delivery_queue()
+    print(f"✅ Processed {handled} queued deliveries")
 
 @app.route('/webhook/telegram', methods=['POST'])
 def telegram_webhook():
     """Handle Telegram bot callbacks and messages"""
+    import requests
     print("🔔 Telegram webhook received")
     data = request.get_json()
     print(f"📨 Webhook data: {data}")
@@ -4514,78 +6488,42 @@ Copy this number: {chat_id}"""
             order_id = int(callback_data.split('_')[1])
             print(f"✅ Confirming order #{order_id}")
             
-            conn = get_db()
-            order = conn.execute('''SELECT o.*, p.name as product_name, p.type, p.file_or_key_path, p.price_dzd
-                                   FROM orders o 
-                                   JOIN products p ON o.product_id = p.id 
-                                   WHERE o.id = ?''', (order_id,)).fetchone()
+            order, reason = transition_order(order_id, 'confirm', 'telegram_admin')
+            if order:
+                deliver_product(order)  # Receipt will be generated in deliver_product
+                text = f"✅ Order #{order_id} confirmed, product delivered, and receipt generated!"
+            else:
+                text = f"⚠️ Order #{order_id} not confirmed: {reason}"
             
-            if order and order['status'] == 'pending':
-                # Confirm order
-                confirmation_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                conn.execute('UPDATE orders SET status = "confirmed", confirmed_at = ? WHERE id = ?',
-                            (confirmation_time, order_id))
-                # Decrease stock (for key products, this is handled in get_available_key)
-                if order['type'] != 'key':
-                    conn.execute('UPDATE products SET stock_count = stock_count - 1 WHERE id = ?',
-                                (order['product_id'],))
-                else:
-                    # For key products, update stock to reflect available unused keys
-                    available_keys = conn.execute('SELECT COUNT(*) FROM product_keys WHERE product_id = ? AND is_used = FALSE',
-                                                (order['product_id'],)).fetchone()[0]
-                    conn.execute('UPDATE products SET stock_count = ? WHERE id = ?',
-                                (available_keys, order['product_id']))
-                conn.commit()
-                
-                # Get updated order data for delivery
-                updated_order = conn.execute('''SELECT o.*, p.name as product_name, p.type, p.file_or_key_path, p.price_dzd
-                                               FROM orders o 
-                                               JOIN products p ON o.product_id = p.id 
-                                               WHERE o.id = ?''', (order_id,)).fetchone()
-                
-                log_action(order_id, 'order_confirmed', 'telegram_admin')
-                deliver_product(updated_order)  # Receipt will be generated in deliver_product
-                
-                # Send confirmation to admin
-                bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
-                url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-                response_data = {
-                    "chat_id": chat_id,
-                    "text": f"✅ Order #{order_id} confirmed, product delivered, and receipt generated!"
-                }
+            # Send confirmation to admin
+            bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
+            url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+            response_data = {
+                "chat_id": chat_id,
+                "text": text
+            }
+            with timed_external_call('telegram'):
                 requests.post(url, json=response_data)
             
-            conn.close()
-            
         elif callback_data.startswith('reject_'):
             order_id = int(callback_data.split('_')[1])
             
-            conn = get_db()
-            
-            # Get order info before rejecting
-            order = conn.execute('''SELECT o.*, p.name as product_name
-                                   FROM orders o 
-                                   JOIN products p ON o.product_id = p.id 
-                                   WHERE o.id = ?''', (order_id,)).fetchone()
-            
-            conn.execute('UPDATE orders SET status = "rejected" WHERE id = ?', (order_id,))
-            conn.commit()
-            conn.close()
-            
-            # Notify buyer if order exists
+            order, reason = transition_order(order_id, 'reject', 'telegram_admin')
             if order:
                 notify_buyer_rejection(order)
-            
-            log_action(order_id, 'order_rejected', 'telegram_admin')
+                text = f"❌ Order #{order_id} rejected and buyer notified!"
+            else:
+                text = f"⚠️ Order #{order_id} not rejected: {reason}"
             
             # Send confirmation to admin
             bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
             url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
             response_data = {
                 "chat_id": chat_id,
-                "text": f"❌ Order #{order_id} rejected and buyer notified!"
+                "text": text
             }
-            requests.post(url, json=response_data)
+            with timed_external_call('telegram'):
+                requests.post(url, json=response_data)
     
     return jsonify({"status": "ok"})
 
@@ -4745,6 +6683,44 @@ def export_sales():
         download_name='sales_export.csv'
     )
 
+def serve_file(file_path, as_attachment=False, download_name=None, mimetype=None, etag=True, last_modified=None):
+    """Serve a file, handing the transfer to the front-end server when offload is enabled.
+
+    Auth and token checks must already have passed. With FILE_OFFLOAD_MODE unset the
+    file is streamed by the worker through send_file, exactly as before.
+    """
+    mode = app.config.get('FILE_OFFLOAD_MODE')
+    abs_path = os.path.abspath(file_path)
+    rel_path = os.path.relpath(abs_path, os.path.abspath('.'))
+
+    # Only files inside the app directory can be mapped to the internal location
+    if mode not in ('x-accel', 'x-sendfile') or (mode == 'x-accel' and rel_path.startswith('..')):
+        return send_file(abs_path, as_attachment=as_attachment, download_name=download_name, mimetype=mimetype,
+                         etag=etag, last_modified=last_modified)
+
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(download_name or abs_path)[0] or 'application/octet-stream'
+
+    response = app.response_class(mimetype=mimetype)
+    if mode == 'x-accel':
+        prefix = app.config['X_ACCEL_PREFIX'].rstrip('/')
+        response.headers['X-Accel-Redirect'] = f"{prefix}/{quote(rel_path.replace(os.sep, '/'))}"
+    else:
+        response.headers['X-Sendfile'] = abs_path
+
+    # Same Content-Disposition handling as send_file, including non-ASCII names
+    if download_name is None:
+        download_name = os.path.basename(abs_path)
+    try:
+        download_name.encode('ascii')
+        names = {'filename': download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple, 'filename*': f"UTF-8''{quote(download_name, safe='!#$&+^`|~')}"}
+    response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline', **names)
+
+    return response
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """Serve uploaded payment proof files (public access for admin viewing)"""
@@ -4755,24 +6731,12 @@ def uploaded_file(filename):
     
     file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
     
-    print(f"🔍 Admin requesting file: {filename}")
-    print(f"🔍 Full file path: {file_path}")
-    print(f"🔍 File exists: {os.path.exists(file_path)}")
-    
     if not os.path.exists(file_path):
         print(f"❌ Payment proof file not found: {file_path}")
-        # List files in uploads directory for debugging
-        if os.path.exists(app.config['UPLOAD_FOLDER']):
-            files = os.listdir(app.config['UPLOAD_FOLDER'])
-            print(f"🔍 Files in uploads directory: {files}")
-        else:
-            print(f"❌ Uploads directory doesn't exist: {app.config['UPLOAD_FOLDER']}")
-        
         return jsonify({'error': 'File not found'}), 404
     
     try:
-        print(f"✅ Serving file to admin: {file_path}")
-        return send_file(file_path)
+        return serve_file(file_path)
     except Exception as e:
         print(f"❌ Error serving payment proof file: {e}")
         return jsonify({'error': 'Error loading file'}), 500
@@ -4793,7 +6757,7 @@ def download_receipt(order_id):
         flash('Receipt file not found', 'error')
         return redirect(url_for('admin_dashboard'))
     
-    return send_file(order['receipt_path'], as_attachment=True, download_name=f"receipt_{order_id}.pdf")
+    return serve_file(order['receipt_path'], as_attachment=True, download_name=f"receipt_{order_id}.pdf")
 
 @app.route('/admin/payment-proof/<filename>')
 @admin_required
@@ -4812,7 +6776,7 @@ def admin_payment_proof(filename):
     try:
         print(f"✅ Serving payment proof: {file_path}")
         # Send file with proper headers for image display
-        response = send_file(file_path)
+        response = serve_file(file_path)
         response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
         response.headers['Pragma'] = 'no-cache'
         response.headers['Expires'] = '0'
@@ -4877,6 +6841,116 @@ def admin_download_tokens():
         flash(f'Error loading download tokens: {e}', 'error')
         return redirect(url_for('admin_dashboard'))
 
+@app.route('/admin/slow-queries')
+@admin_required
+def admin_slow_queries():
+    """Slowest SQL statement shapes recorded by the query instrumentation"""
+    flush_slow_queries()
+    sort = request.args.get('sort', 'total')
+    order_by = {'total': 'total_ms', 'max': 'max_ms', 'calls': 'calls', 'recent': 'last_seen'}.get(sort, 'total_ms')
+    
+    conn = get_db()
+    queries = conn.execute(f'''SELECT *, total_ms / MAX(calls, 1) AS avg_ms FROM slow_queries 
+                              ORDER BY {order_by} DESC LIMIT 50''').fetchall()
+    summary = conn.execute('''SELECT COUNT(*) AS shapes, COALESCE(SUM(calls), 0) AS calls, 
+                              COALESCE(SUM(total_ms), 0) AS total_ms, COALESCE(SUM(full_scan), 0) AS full_scans 
+                              FROM slow_queries''').fetchone()
+    conn.close()
+    
+    return render_template('admin_slow_queries.html', 
+                         queries=queries, 
+                         summary=summary, 
+                         sort=sort,
+                         threshold_ms=app.config['SLOW_QUERY_MS'])
+
+@app.route('/admin/slow-queries/clear', methods=['POST'])
+@admin_required
+def clear_slow_queries():
+    conn = get_db()
+    conn.execute('DELETE FROM slow_queries')
+    conn.commit()
+    conn.close()
+    flash('Slow query log cleared', 'success')
+    return redirect(url_for('admin_slow_queries'))
+
+@app.route('/admin/profiles')
+@admin_required
+def admin_profiles():
+    """Stored request profiles, newest first"""
+    conn = get_db()
+    profiles = conn.execute('SELECT * FROM request_profiles ORDER BY id DESC').fetchall()
+    conn.close()
+    return render_template('admin_profiles.html', 
+                         profiles=profiles, 
+                         sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+                         slow_ms=app.config['PROFILE_SLOW_MS'])
+
+@app.route('/admin/profiles/<int:profile_id>')
+@admin_required
+def admin_profile_detail(profile_id):
+    """Top functions of one profile"""
+    import pstats
+    
+    conn = get_db()
+    profile = conn.execute('SELECT * FROM request_profiles WHERE id = ?', (profile_id,)).fetchone()
+    conn.close()
+    if not profile:
+        flash('Profile not found', 'error')
+        return redirect(url_for('admin_profiles'))
+    
+    sort = request.args.get('sort', 'cumulative')
+    if sort not in ('cumulative', 'tottime', 'ncalls'):
+        sort = 'cumulative'
+    try:
+        stats = pstats.Stats(os.path.join(app.config['PROFILE_DIR'], profile['filename']))
+    except OSError:
+        flash('Profile file not found', 'error')
+        return redirect(url_for('admin_profiles'))
+    
+    # stats.stats maps (file, line, function) to (primitive calls, calls, own time, cumulative time, callers)
+    column = {'cumulative': 3, 'tottime': 2, 'ncalls': 1}[sort]
+    entries = sorted(stats.stats.items(), key=lambda item: item[1][column], reverse=True)[:80]
+    functions = [{
+        'location': f"{os.path.basename(filename)}:{line}" if line else filename,
+        'function': name,
+        'ncalls': calls if calls == primitive_calls else f'{calls}/{primitive_calls}',
+        'tottime_ms': tottime * 1000,
+        'cumtime_ms': cumtime * 1000,
+        'percall_ms': cumtime * 1000 / calls if calls else 0,
+    } for (filename, line, name), (primitive_calls, calls, tottime, cumtime, _) in entries]
+    
+    return render_template('admin_profile_detail.html', 
+                         profile=profile, 
+                         functions=functions, 
+                         sort=sort,
+                         total_calls=stats.total_calls,
+                         total_ms=stats.total_tt * 1000)
+
+@app.route('/admin/profiles/<int:profile_id>/download')
+@admin_required
+def download_profile(profile_id):
+    conn = get_db()
+    profile = conn.execute('SELECT * FROM request_profiles WHERE id = ?', (profile_id,)).fetchone()
+    conn.close()
+    path = os.path.join(app.config['PROFILE_DIR'], profile['filename']) if profile else None
+    if not path or not os.path.exists(path):
+        flash('Profile not found', 'error')
+        return redirect(url_for('admin_profiles'))
+    return send_file(os.path.abspath(path), as_attachment=True, download_name=f"profile-{profile_id}.prof",
+                     mimetype='application/octet-stream')
+
+@app.route('/admin/profiles/clear', methods=['POST'])
+@admin_required
+def clear_profiles():
+    conn = get_db()
+    for row in conn.execute('SELECT filename FROM request_profiles').fetchall():
+        delete_profile_file(row['filename'])
+    conn.execute('DELETE FROM request_profiles')
+    conn.commit()
+    conn.close()
+    flash('Profiles deleted', 'success')
+    return redirect(url_for('admin_profiles'))
+
 @app.route('/admin/debug/uploads')
 @admin_required
 def debug_uploads():
@@ -5222,6 +7296,27 @@ def toggle_product_visibility(product_id):
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+def download_etag(file_stat):
+    """ETag for a download in nginx's format, so offloaded and Python-served responses agree"""
+    return f"{int(file_stat.st_mtime):x}-{file_stat.st_size:x}"
+
+def is_resumed_download(etag, mtime):
+    """True when the request continues an earlier transfer of the same file.
+
+    That means a Range that doesn't start at byte 0 and, when If-Range is sent, a
+    validator that still matches (otherwise the full file is sent again).
+    """
+    byte_range = request.range
+    if not byte_range or not byte_range.ranges or byte_range.ranges[0][0] == 0:
+        return False
+    
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return int(if_range.date.timestamp()) >= int(mtime)
+    return True
+
 @app.route('/download/<token>')
 def secure_download(token):
     """Secure download route using tokens"""
@@ -5261,8 +7356,8 @@ def secure_download(token):
         </div>
         '''), 410
     
-    # Check download limit
-    if token_info['download_count'] >= token_info['max_downloads']:
+    # Check download limit (resumes of a counted download are checked below)
+    if token_info['download_count'] >= token_info['max_downloads'] and not request.range:
         conn.close()
         return render_template_string('''
         <div style="text-align: center; padding: 50px; font-family: Arial, sans-serif;">
@@ -5285,28 +7380,65 @@ def secure_download(token):
         </div>
         '''), 404
     
-    # Update download count
-    new_count = token_info['download_count'] + 1
-    conn.execute('''UPDATE download_tokens 
-                   SET download_count = ?, used_at = CURRENT_TIMESTAMP 
-                   WHERE token = ?''', (new_count, token))
+    # Only a fresh transfer counts as a download; Range requests continuing it don't
+    file_stat = os.stat(token_info['file_path'])
+    etag = download_etag(file_stat)
+    is_resume = token_info['download_count'] > 0 and is_resumed_download(etag, file_stat.st_mtime)
+    
+    if request.method == 'HEAD':
+        updated = 1
+    else:
+        updated = 0
+        if is_resume:
+            # A resume continues the latest counted download: it has to come soon after it, and
+            # each counted download allows a few (resume_count restarts with every download)
+            updated = conn.execute('''UPDATE download_tokens 
+                                     SET resume_count = COALESCE(resume_count, 0) + 1 
+                                     WHERE token = ? AND COALESCE(resume_count, 0) < ?
+                                       AND used_at >= datetime('now', ?)''',
+                                   (token, app.config['DOWNLOAD_RESUMES_PER_DOWNLOAD'],
+                                    f"-{app.config['DOWNLOAD_RESUME_WINDOW']} seconds")).rowcount
+            is_resume = bool(updated)
+        if not is_resume:
+            updated = conn.execute('''UPDATE download_tokens 
+                                     SET download_count = download_count + 1, used_at = CURRENT_TIMESTAMP, resume_count = 0 
+                                     WHERE token = ? AND download_count < max_downloads''', (token,)).rowcount
     conn.commit()
     conn.close()
     
+    if not updated:
+        return render_template_string('''
+        <div style="text-align: center; padding: 50px; font-family: Arial, sans-serif;">
+            <h2 style="color: #dc3545;">📥 Download Limit Reached</h2>
+            <p>This download link has reached its maximum usage limit.</p>
+            <p>Please contact support if you need additional downloads.</p>
+            <p><a href="/" style="color: #007bff;">← Back to Store</a></p>
+        </div>
+        '''), 429
+    
     # Log the download
-    print(f"📥 Secure download: {token_info['buyer_name']} downloading {token_info['product_name']} (#{new_count}/{token_info['max_downloads']})")
+    if request.method == 'HEAD':
+        pass
+    elif is_resume:
+        print(f"📥 Secure download resumed: {token_info['buyer_name']} downloading {token_info['product_name']} ({request.headers.get('Range')})")
+    else:
+        print(f"📥 Secure download: {token_info['buyer_name']} downloading {token_info['product_name']} (#{token_info['download_count'] + 1}/{token_info['max_downloads']})")
     
-    # Serve the file
+    # Serve the file (send_file answers Range / If-Range with 206 or the full body)
     try:
         original_filename = os.path.basename(token_info['file_path'])
         download_name = f"{token_info['product_name']}_{original_filename}"
         
-        return send_file(
+        response = serve_file(
             token_info['file_path'], 
             as_attachment=True, 
             download_name=download_name,
-            mimetype='application/octet-stream'
+            mimetype='application/octet-stream',
+            etag=etag,
+            last_modified=file_stat.st_mtime
         )
+        response.headers['Cache-Control'] = 'private, no-transform'
+        return response
     except Exception as e:
         print(f"❌ Error serving download: {e}")
         return render_template_string('''
@@ -5341,10 +7473,11 @@ def download_product_file(order_id):
     original_filename = os.path.basename(order['file_or_key_path'])
     download_name = f"{order['product_name']}_{original_filename}"
     
-    return send_file(order['file_or_key_path'], as_attachment=True, download_name=download_name)
+    return serve_file(order['file_or_key_path'], as_attachment=True, download_name=download_name)
 
 if __name__ == '__main__':
-    # Database is already initialized at module level
+    ensure_db()
+    warm_caches()
     
     # Get port from environment variable (for Render) or default to 5000
     port = int(os.environ.get('PORT', 5000))
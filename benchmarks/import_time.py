@@ -0,0 +1,103 @@
+"""Measure how long `import app` takes, using python -X importtime.
+
+Importing the app is what every gunicorn worker (and every `flask` CLI call) pays
+before it can serve anything, so heavy modules should only load on first use. The
+import runs in a scratch directory so it never touches a real store.db.
+
+    python benchmarks/import_time.py --runs 5 --max-ms 400 --forbid reportlab,resend,requests
+
+Exits non-zero when the median import is over --max-ms or a forbidden module was
+imported, so it can run as a CI check.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(workdir):
+    """Import the app once in a fresh interpreter.
+
+    Returns {module: (self_us, cumulative_us, depth)} for `app` and everything imported
+    underneath it, leaving out interpreter startup (site, .pth hooks).
+    """
+    code = f'import sys; sys.path.insert(0, {REPO_ROOT!r}); import app'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=workdir, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else 'import failed')
+
+    # Children are printed before their parent, so collect lines until a top-level
+    # module shows up and keep the batch that ends with `app`.
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules[name.strip()] = (int(self_us), int(cumulative_us), depth)
+        if depth == 0:
+            if name.strip() == 'app':
+                return modules
+            modules = {}
+    raise RuntimeError('app not found in -X importtime output')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='slowest modules to list')
+    parser.add_argument('--max-ms', type=float, help='fail if the median import is slower')
+    parser.add_argument('--forbid', default='', help='comma-separated modules that must not load at import')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='dzkeyz-import-')
+    try:
+        runs = [measure(workdir) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    totals_ms = [run['app'][1] / 1000 for run in runs]
+    median_ms = statistics.median(totals_ms)
+    last = runs[-1]
+    # Direct imports of app.py, with everything they pulled in
+    slowest = sorted(((cum, name) for name, (_, cum, depth) in last.items() if depth == 1),
+                     reverse=True)[:args.top]
+    forbidden = [name.strip() for name in args.forbid.split(',') if name.strip() in last]
+
+    failures = []
+    if args.max_ms is not None and median_ms > args.max_ms:
+        failures.append(f'median import {median_ms:.1f} ms is over the {args.max_ms:.0f} ms budget')
+    if forbidden:
+        failures.append(f"imported at startup: {', '.join(forbidden)}")
+
+    if args.json:
+        print(json.dumps({
+            'median_ms': round(median_ms, 1),
+            'runs_ms': [round(t, 1) for t in totals_ms],
+            'slowest': [{'module': name, 'ms': round(cum / 1000, 1)} for cum, name in slowest],
+            'forbidden_loaded': forbidden,
+            'ok': not failures,
+        }, indent=2))
+    else:
+        print(f"import app: median {median_ms:.1f} ms over {args.runs} runs "
+              f"(min {min(totals_ms):.1f}, max {max(totals_ms):.1f})")
+        print()
+        print(f"{'imported by app':<30}{'cumulative ms':>15}")
+        for cum, name in slowest:
+            print(f'{name:<30}{cum / 1000:>15.1f}')
+        for failure in failures:
+            print(f'❌ {failure}')
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
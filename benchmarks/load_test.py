@@ -0,0 +1,313 @@
+"""Replay storefront, checkout and admin traffic against a seeded store.
+
+The store is seeded with benchmarks/seed.py (or reused from --seed-dir) and copied to
+a scratch directory, so every run starts from the same data. Resend and Telegram are
+stubbed by benchmarks/stub_app.py. Requests go through Flask's test client
+(--mode client, no network) or a local gunicorn (--mode gunicorn).
+
+    python benchmarks/load_test.py --size 10k --mix full --duration 20
+    python benchmarks/load_test.py --size 100k --mode gunicorn --concurrency 16 --json out.json
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import seed as seeder  # noqa: E402
+
+# 1x1 PNG used as the payment proof
+PROOF_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c4890000000d49444154789c63f8cfc0f01f0005'
+    '0001ff5cc2b3640000000049454e44ae426082')
+
+SEARCH_TERMS = [word.lower() for word in seeder.ADJECTIVES + seeder.NOUNS] + ['gold edition', 'ultimate', 'xx']
+
+# scenario -> (expected status, request builder)
+SCENARIOS = {
+    'home': (200, lambda rng, n: ('GET', '/', None)),
+    'product_details': (200, lambda rng, n: ('GET', f'/product/{rng.randint(1, n)}', None)),
+    'search_products': (200, lambda rng, n: ('GET', f'/search_products?q={quote(rng.choice(SEARCH_TERMS))}', None)),
+    'submit_order': (302, lambda rng, n: ('POST', '/submit_order', {
+        'product_id': str(rng.randint(1, n)),
+        'buyer_name': 'Bench Buyer',
+        'email': f'buyer{rng.randrange(10 ** 6)}@bench.example',
+        'phone': '0555000000',
+        'telegram_username': '',
+        'payment_method': rng.choice(['baridimob', 'ccp']),
+        'transaction_id': f'TX{rng.randrange(10 ** 10)}',
+    })),
+    'admin_orders': (200, lambda rng, n: ('GET', '/admin/orders' if rng.random() < 0.7
+                                          else f'/admin/orders?search={quote(rng.choice(seeder.LAST_NAMES))}', None)),
+    'admin_analytics': (200, lambda rng, n: ('GET', '/admin/analytics', None)),
+}
+
+# Sessions the scenarios run in: storefront pages as an anonymous visitor (so they go through
+# the page cache like real customers), checkout as a separate anonymous buyer whose flash
+# messages don't follow the visitor around, and only the admin pages logged in
+SCENARIO_ROLES = {'submit_order': 'buyer', 'admin_orders': 'admin', 'admin_analytics': 'admin'}
+
+MIXES = {
+    'storefront': {'home': 40, 'product_details': 40, 'search_products': 20},
+    'checkout': {'product_details': 50, 'submit_order': 50},
+    'admin': {'admin_orders': 60, 'admin_analytics': 40},
+    'full': {'home': 30, 'product_details': 30, 'search_products': 15, 'submit_order': 5,
+             'admin_orders': 12, 'admin_analytics': 8},
+}
+
+
+def bench_env(args):
+    """Environment for the app under test: stubs on, background work and log noise off"""
+    return dict(os.environ,
+                BENCH_UPSTREAM_LATENCY=str(args.latency),
+                MAINTENANCE_INTERVAL='0',
+                REQUEST_LOG_SAMPLE_RATE='0',
+                REQUEST_LOG_SLOW_MS='1e9',
+                SLOW_QUERY_MS='0',
+                METRICS_FLUSH_INTERVAL='1e9')
+
+
+def encode_multipart(fields, files):
+    boundary = f'bench{random.randrange(16 ** 16):016x}'
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content, content_type) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: {content_type}\r\n\r\n'.encode() + content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class ClientTarget:
+    """In-process requests through Flask's test client"""
+
+    def __init__(self, workdir, args):
+        os.environ.update(bench_env(args))
+        os.chdir(workdir)
+        import stub_app
+        self.app = stub_app.app
+        self.app.config['REQUEST_LOG_SAMPLE_RATE'] = 0
+        # The app prints progress for orders and emails; keep it off the report. sys.stdout is
+        # shared by the client threads, so it is swapped once for the run rather than per request
+        self.devnull = open(os.devnull, 'w')
+        self.stdout, sys.stdout = sys.stdout, self.devnull
+
+    def session(self, admin=False):
+        client = self.app.test_client()
+        if admin:
+            with client.session_transaction() as sess:
+                sess['admin_logged_in'] = True
+        return client
+
+    def request(self, client, method, path, form):
+        if form is None:
+            return client.open(path, method=method).status_code
+        data = dict(form, payment_proof=(io.BytesIO(PROOF_PNG), 'proof.png'))
+        return client.open(path, method=method, data=data, content_type='multipart/form-data').status_code
+
+    def close(self):
+        sys.stdout = self.stdout
+        self.devnull.close()
+
+
+class GunicornTarget:
+    """Requests over HTTP to a local gunicorn running stub_app"""
+
+    def __init__(self, workdir, args):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        env = bench_env(args)
+        env['GUNICORN_PROFILE'] = args.profile
+        if args.workers:
+            env['WEB_CONCURRENCY'] = str(args.workers)
+        cmd = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO_ROOT, 'gunicorn_config.py'),
+               '--bind', f'127.0.0.1:{self.port}', '--chdir', workdir,
+               '--pythonpath', f'{REPO_ROOT},{BENCH_DIR}', '--log-level', 'warning', 'stub_app:app']
+        self.server = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.time() + 60
+        while time.time() < deadline:
+            try:
+                if self._call(self._connect(), 'GET', '/health')[0] == 200:
+                    return
+            except OSError:
+                time.sleep(0.2)
+        self.close()
+        raise RuntimeError('gunicorn did not start')
+
+    def _connect(self):
+        return http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+
+    def _call(self, conn, method, path, body=None, headers=None):
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        response.read()
+        return response.status, response.getheader('Set-Cookie')
+
+    def session(self, admin=False):
+        conn = self._connect()
+        cookie = None
+        if admin:
+            status, cookie = self._call(conn, 'POST', '/admin/login', body='username=admin&password=admin123',
+                                        headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        return {'conn': conn, 'cookie': cookie.split(';', 1)[0] if cookie else ''}
+
+    def request(self, session, method, path, form):
+        headers = {'Cookie': session['cookie']} if session['cookie'] else {}
+        body = None
+        if form is not None:
+            body, headers['Content-Type'] = encode_multipart(form, {'payment_proof': ('proof.png', PROOF_PNG, 'image/png')})
+        try:
+            return self._call(session['conn'], method, path, body, headers)[0]
+        except (OSError, http.client.HTTPException):
+            session['conn'].close()
+            session['conn'] = self._connect()
+            return 0
+
+    def close(self):
+        self.server.terminate()
+        self.server.wait(timeout=30)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def run(target, mix, n_products, args):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    results = {name: {'latencies': [], 'errors': 0} for name in names}
+    lock = threading.Lock()
+    stop_at = time.time() + args.duration
+    remaining = [args.requests] if args.requests else None
+
+    def worker(n):
+        rng = random.Random(args.seed * 1000 + n)
+        sessions = {}
+        while True:
+            with lock:
+                if remaining is not None:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+            if remaining is None and time.time() >= stop_at:
+                return
+            name = rng.choices(names, weights)[0]
+            expected, build = SCENARIOS[name]
+            method, path, form = build(rng, n_products)
+            role = SCENARIO_ROLES.get(name, 'visitor')
+            if role not in sessions:
+                sessions[role] = target.session(admin=role == 'admin')
+            started = time.perf_counter()
+            status = target.request(sessions[role], method, path, form)
+            elapsed = time.perf_counter() - started
+            with lock:
+                if status == expected:
+                    results[name]['latencies'].append(elapsed)
+                else:
+                    results[name]['errors'] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.perf_counter() - started
+
+
+def summarize(results, wall):
+    rows = {}
+    everything = []
+    for name, data in results.items():
+        lat = data['latencies']
+        everything.extend(lat)
+        rows[name] = {
+            'requests': len(lat), 'errors': data['errors'], 'rps': round(len(lat) / wall, 1),
+            'p50_ms': round(percentile(lat, 50) * 1000, 2), 'p95_ms': round(percentile(lat, 95) * 1000, 2),
+            'p99_ms': round(percentile(lat, 99) * 1000, 2),
+        }
+    rows['total'] = {
+        'requests': len(everything), 'errors': sum(d['errors'] for d in results.values()),
+        'rps': round(len(everything) / wall, 1),
+        'p50_ms': round(percentile(everything, 50) * 1000, 2), 'p95_ms': round(percentile(everything, 95) * 1000, 2),
+        'p99_ms': round(percentile(everything, 99) * 1000, 2),
+    }
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', choices=sorted(seeder.SIZES), default='10k')
+    parser.add_argument('--seed-dir', help='reuse a directory seeded by benchmarks/seed.py with the same --size')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--mix', choices=sorted(MIXES), default='full')
+    parser.add_argument('--mode', choices=['client', 'gunicorn'], default='client')
+    parser.add_argument('--profile', default='gthread', help='GUNICORN_PROFILE for --mode gunicorn')
+    parser.add_argument('--workers', type=int, help='WEB_CONCURRENCY for --mode gunicorn')
+    parser.add_argument('--concurrency', type=int, default=1, help='client threads')
+    parser.add_argument('--duration', type=float, default=15, help='seconds (ignored with --requests)')
+    parser.add_argument('--requests', type=int, help='stop after this many requests instead of --duration')
+    parser.add_argument('--latency', type=float, default=0.0, help='stubbed Resend/Telegram latency (s)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    n_products = seeder.SIZES[args.size]
+    workdir = tempfile.mkdtemp(prefix=f'dzkeyz-load-{args.size}-')
+    try:
+        if args.seed_dir and os.path.exists(os.path.join(args.seed_dir, 'store.db')):
+            shutil.copy(os.path.join(args.seed_dir, 'store.db'), workdir)
+        else:
+            print(f'🌱 Seeding {n_products} products...')
+            counts = seeder.seed(workdir, n_products, args.seed)
+            if args.seed_dir:
+                os.makedirs(args.seed_dir, exist_ok=True)
+                shutil.copy(os.path.join(workdir, 'store.db'), args.seed_dir)
+            print('   ' + ', '.join(f'{count} {table}' for table, count in counts.items()))
+
+        target = (ClientTarget if args.mode == 'client' else GunicornTarget)(workdir, args)
+        try:
+            results, wall = run(target, MIXES[args.mix], n_products, args)
+        finally:
+            target.close()
+    finally:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    rows = summarize(results, wall)
+    print()
+    print(f'{args.mix} mix, {args.size} products, {args.mode} mode, {args.concurrency} client(s), {wall:.1f}s')
+    print(f"{'scenario':<18}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, row in rows.items():
+        print(f"{name:<18}{row['requests']:>9}{row['errors']:>8}{row['rps']:>9.1f}"
+              f"{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'size': args.size, 'mix': args.mix, 'mode': args.mode, 'concurrency': args.concurrency,
+                'seconds': round(wall, 2), 'python': platform.python_version(), 'results': rows,
+            }, f, indent=2)
+    return 1 if rows['total']['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
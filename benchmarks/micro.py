@@ -0,0 +1,245 @@
+"""Micro-benchmarks for hot helpers, with JSON baselines and a regression check.
+
+Each benchmark is timed in rounds of enough calls to take --min-time seconds. compare
+uses the fastest round by default (the least disturbed by other processes, as timeit
+recommends) or the median with --stat median.
+
+    python benchmarks/micro.py run                          # print timings
+    python benchmarks/micro.py run --save benchmarks/baselines/micro.json
+    python benchmarks/micro.py compare --threshold 25       # exit 1 on a >25% regression
+
+Baselines are machine-specific: regenerate them (run --save) on the machine that runs
+compare. DB-backed benchmarks use a scratch store seeded by benchmarks/seed.py.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baselines', 'micro.json')
+CATALOG_SIZE = 1000
+
+sys.path.insert(0, BENCH_DIR)
+
+
+def bench_get_product_images(app):
+    images = json.dumps([f'product_{i}.webp' for i in range(6)])
+    return lambda: app.get_product_images(images)
+
+
+def bench_get_product_images_legacy(app):
+    images = ', '.join(f'product_{i}.webp' for i in range(6))
+    return lambda: app.get_product_images(images)
+
+
+def bench_from_json_filter(app):
+    value = json.dumps(['a.webp', 'b.webp', 'c.webp'])
+    return lambda: app.from_json_filter(value)
+
+
+def bench_format_professional_email(app):
+    body = 'Your order #1234 has been confirmed.\n\n' + 'Download link: https://example.com/d/abc\n' * 5
+    return lambda: app.format_professional_email('Amine Benali', body, 'order_confirmation')
+
+
+def bench_generate_receipt_pdf(app):
+    order = {
+        'id': 4242, 'buyer_name': 'Amine Benali', 'email': 'amine@example.com', 'phone': '0555000000',
+        'telegram_username': 'amine', 'payment_method': 'baridimob', 'product_name': 'Iron Legends Deluxe',
+        'price_dzd': 2500.0, 'confirmed_at': '2024-05-01 10:00:00', 'created_at': '2024-05-01 09:00:00',
+        'transaction_id': 'TX123', 'type': 'key',
+    }
+    return lambda: app.generate_receipt_pdf(order)
+
+
+def bench_search_products(app):
+    # Whole search view over the seeded catalog: rapidfuzz scoring when installed,
+    # the LIKE fallback otherwise (recorded in the results' meta.search_scorer)
+    def run():
+        with app.app.test_request_context('/search_products?q=iron legends'):
+            return app.search_products()
+    return run
+
+
+def bench_get_available_key(app):
+    # Each call hands out a key; putting it back keeps the key pool (and the timing)
+    # stable, so the measured time includes one extra UPDATE
+    conn = sqlite3.connect('store.db')
+    product_id = conn.execute("SELECT product_id FROM product_keys GROUP BY product_id LIMIT 1").fetchone()[0]
+
+    def run():
+        key = app.get_available_key(product_id, 0)
+        conn.execute('UPDATE product_keys SET is_used = FALSE, used_by_order_id = NULL WHERE key_value = ?', (key,))
+        conn.commit()
+        return key
+    return run
+
+
+BENCHMARKS = {
+    'get_product_images': bench_get_product_images,
+    'get_product_images_legacy': bench_get_product_images_legacy,
+    'from_json_filter': bench_from_json_filter,
+    'format_professional_email': bench_format_professional_email,
+    'generate_receipt_pdf': bench_generate_receipt_pdf,
+    'search_products': bench_search_products,
+    'get_available_key': bench_get_available_key,
+}
+
+
+def time_callable(func, rounds, min_time):
+    """Return per-call timings (seconds) for `rounds` rounds of N calls each"""
+    func()  # warm up (imports, caches)
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time or loops >= 1_000_000:
+            break
+        loops = max(loops * 2, int(loops * min_time / max(elapsed, 1e-9)))
+
+    timings = [elapsed / loops]
+    for _ in range(rounds - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        timings.append((time.perf_counter() - started) / loops)
+    return timings, loops
+
+
+def run_benchmarks(names, rounds, min_time):
+    workdir = tempfile.mkdtemp(prefix='dzkeyz-micro-')
+    cwd = os.getcwd()
+    os.environ.update(MAINTENANCE_INTERVAL='0', REQUEST_LOG_SAMPLE_RATE='0', SLOW_QUERY_MS='0')
+    try:
+        import seed as seeder
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            seeder.seed(workdir, CATALOG_SIZE)
+            os.chdir(workdir)
+            import app
+
+        try:
+            import rapidfuzz  # noqa: F401
+            scorer = 'rapidfuzz'
+        except ImportError:
+            scorer = 'like-fallback'
+
+        results = {}
+        for name in names:
+            func = BENCHMARKS[name](app)
+            # The helpers log with print(); keep that out of the timings output
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                timings, loops = time_callable(func, rounds, min_time)
+            results[name] = {
+                'median_us': round(statistics.median(timings) * 1e6, 3),
+                'min_us': round(min(timings) * 1e6, 3),
+                'stdev_us': round(statistics.stdev(timings) * 1e6, 3) if len(timings) > 1 else 0.0,
+                'rounds': rounds,
+                'loops': loops,
+            }
+            print(f"  {name:<28}{results[name]['min_us']:>12.2f} us min {results[name]['median_us']:>12.2f} us median")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'catalog_size': CATALOG_SIZE,
+            'search_scorer': scorer,
+        },
+        'benchmarks': results,
+    }
+
+
+def compare(baseline, current, threshold, stat='min', min_delta_us=2.0):
+    """Print a comparison table and return the names that regressed past threshold %.
+
+    A change also has to exceed min_delta_us: helpers that take a microsecond or two
+    drift by tens of percent between interpreter runs without any code change.
+    """
+    key = f'{stat}_us'
+    regressions = []
+    print(f"{'benchmark':<28}{'baseline us':>14}{'current us':>14}{'change':>10}")
+    for name, result in current['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if not base:
+            print(f"{name:<28}{'-':>14}{result[key]:>14.2f}{'new':>10}")
+            continue
+        change = (result[key] - base[key]) / base[key] * 100
+        flag = ''
+        if change > threshold and result[key] - base[key] > min_delta_us:
+            regressions.append(name)
+            flag = '  ❌'
+        print(f"{name:<28}{base[key]:>14.2f}{result[key]:>14.2f}{change:>+9.1f}%{flag}")
+    if baseline['meta'].get('search_scorer') != current['meta'].get('search_scorer'):
+        print(f"⚠️ search_products used {current['meta'].get('search_scorer')} but the baseline used "
+              f"{baseline['meta'].get('search_scorer')}; those timings aren't comparable")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    for command in ('run', 'compare'):
+        p = sub.add_parser(command)
+        p.add_argument('--only', help='comma-separated benchmark names')
+        p.add_argument('--rounds', type=int, default=9)
+        p.add_argument('--min-time', type=float, default=0.05, help='seconds per round')
+    sub.choices['run'].add_argument('--save', help='write the results to this JSON file')
+    sub.choices['compare'].add_argument('--baseline', default=DEFAULT_BASELINE)
+    sub.choices['compare'].add_argument('--current', help='results JSON to check instead of running now')
+    sub.choices['compare'].add_argument('--threshold', type=float, default=25,
+                                        help='fail when a benchmark is slower than the baseline by more than this %%')
+    sub.choices['compare'].add_argument('--stat', choices=['min', 'median'], default='min')
+    sub.choices['compare'].add_argument('--min-delta-us', type=float, default=2.0,
+                                        help='ignore slowdowns smaller than this many microseconds')
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.only.split(',')] if args.only else list(BENCHMARKS)
+    unknown = [n for n in names if n not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    if args.command == 'run':
+        results = run_benchmarks(names, args.rounds, args.min_time)
+        if args.save:
+            os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+            with open(args.save, 'w') as f:
+                json.dump(results, f, indent=2)
+                f.write('\n')
+            print(f'✅ Saved {args.save}')
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if args.current:
+        with open(args.current) as f:
+            current = json.load(f)
+    else:
+        current = run_benchmarks(names, args.rounds, args.min_time)
+    print()
+    regressions = compare(baseline, current, args.threshold, args.stat, args.min_delta_us)
+    if regressions:
+        print(f"❌ Regressed more than {args.threshold:.0f}%: {', '.join(regressions)}")
+        return 1
+    print(f'✅ No benchmark regressed more than {args.threshold:.0f}%')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
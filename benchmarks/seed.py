@@ -0,0 +1,169 @@
+"""Seed a scratch store.db with a synthetic catalog for benchmarks.
+
+Creates the schema with the app's own init_db() and bulk-inserts categories, tags,
+products, keys, users, orders and reviews. The same --size and --seed always produce
+the same data, so runs can be compared.
+
+    python benchmarks/seed.py --size 10k --dir /tmp/dzkeyz-10k
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SIZES = {'100': 100, '10k': 10_000, '100k': 100_000}
+
+CATEGORIES = ['Action', 'Adventure', 'RPG', 'Strategy', 'Sports', 'Racing', 'Simulation',
+              'Horror', 'Puzzle', 'Software', 'Gift Cards', 'Subscriptions']
+TAGS = ['steam', 'origin', 'uplay', 'gog', 'epic', 'xbox', 'playstation', 'nintendo', 'windows',
+        'office', 'antivirus', 'vpn', 'multiplayer', 'co-op', 'indie', 'bestseller', 'new',
+        'sale', 'dlc', 'season-pass']
+ADJECTIVES = ['Dark', 'Eternal', 'Galactic', 'Lost', 'Iron', 'Crimson', 'Silent', 'Wild',
+              'Frozen', 'Shadow', 'Golden', 'Final', 'Hidden', 'Savage', 'Neon', 'Ancient']
+NOUNS = ['Legends', 'Kingdom', 'Odyssey', 'Warfare', 'Racer', 'Frontier', 'Chronicles',
+         'Empire', 'Souls', 'Horizon', 'Protocol', 'Tactics', 'Survivor', 'Dynasty', 'Arena']
+EDITIONS = ['Standard', 'Deluxe', 'Gold', 'Ultimate', 'Complete', 'GOTY', 'Starter Pack']
+FIRST_NAMES = ['Amine', 'Yacine', 'Sara', 'Lina', 'Karim', 'Nadia', 'Walid', 'Imane', 'Riad',
+               'Meriem', 'Sofiane', 'Amel', 'Hichem', 'Rania', 'Mehdi', 'Asma']
+LAST_NAMES = ['Benali', 'Haddad', 'Boudiaf', 'Saidi', 'Mansouri', 'Kaci', 'Ziani', 'Belkacem']
+
+
+def product_name(rng, i):
+    return f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {rng.choice(EDITIONS)} #{i}"
+
+
+def timestamp(rng, days=365):
+    moment = datetime(2024, 1, 1) + timedelta(seconds=rng.randrange(days * 86400))
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def create_schema(directory):
+    """Run the app's init_db() inside `directory` (it works on ./store.db)"""
+    sys.path.insert(0, REPO_ROOT)
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        import app
+        app.init_db()
+    finally:
+        os.chdir(cwd)
+
+
+def seed(directory, n_products, seed_value=42):
+    """Fill directory/store.db and return a summary of what was inserted"""
+    os.makedirs(directory, exist_ok=True)
+    db_path = os.path.join(directory, 'store.db')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    create_schema(directory)
+
+    rng = random.Random(seed_value)
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+
+    conn.executemany('INSERT INTO categories (name, description, icon) VALUES (?, ?, ?)',
+                     [(name, f'{name} titles', 'bi-controller') for name in CATEGORIES])
+    conn.executemany('INSERT INTO tags (name) VALUES (?)', [(name,) for name in TAGS])
+
+    keys_per_product = 5
+    products, product_tags, keys = [], [], []
+    for i in range(1, n_products + 1):
+        kind = 'key' if rng.random() < 0.6 else 'file'
+        stock = keys_per_product if kind == 'key' else rng.randint(0, 500)
+        products.append((
+            i, product_name(rng, i),
+            f'Instant delivery. {rng.choice(NOUNS)} {rng.choice(ADJECTIVES).lower()} edition with all launch content.',
+            float(rng.choice([500, 990, 1500, 2500, 3900, 5500, 7900, 12000])),
+            stock, kind,
+            'products/bench.zip' if kind == 'file' else None,
+            json.dumps([f'bench_{i % 50}.webp']) if rng.random() < 0.7 else None,
+            rng.randint(1, len(CATEGORIES)),
+            rng.random() < 0.97,
+            rng.random() < 0.05,
+            rng.random() < 0.02,
+            timestamp(rng),
+        ))
+        for tag_id in rng.sample(range(1, len(TAGS) + 1), rng.randint(1, 3)):
+            product_tags.append((i, tag_id))
+        if kind == 'key':
+            keys.extend((i, f'BENCH-{i:06d}-{k}-{rng.randrange(16 ** 8):08X}') for k in range(keys_per_product))
+    conn.executemany('''INSERT INTO products (id, name, description, price_dzd, stock_count, type, file_or_key_path,
+                        images, category_id, is_visible, is_featured, special_offer, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', products)
+    conn.executemany('INSERT OR IGNORE INTO product_tags (product_id, tag_id) VALUES (?, ?)', product_tags)
+    conn.executemany('INSERT INTO product_keys (product_id, key_value) VALUES (?, ?)', keys)
+
+    n_users = max(20, n_products // 20)
+    users = []
+    for i in range(1, n_users + 1):
+        name = f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}'
+        users.append((i, name, f'user{i}@bench.example', 'bench', True, timestamp(rng)))
+    conn.executemany('''INSERT INTO users (id, name, email, password_hash, is_active, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?)''', users)
+
+    n_orders = n_products * 2
+    orders = []
+    for i in range(1, n_orders + 1):
+        user_id = rng.randint(1, n_users)
+        created = timestamp(rng)
+        status = rng.choices(['confirmed', 'pending', 'rejected'], weights=[70, 20, 10])[0]
+        orders.append((
+            i, rng.randint(1, n_products), user_id if rng.random() < 0.6 else None,
+            users[user_id - 1][1], users[user_id - 1][2], f'0555{rng.randrange(10 ** 6):06d}', None,
+            rng.choice(['baridimob', 'ccp']), f'proof_{i}.png', f'TX{rng.randrange(10 ** 10):010d}',
+            status, created, created if status == 'confirmed' else None,
+        ))
+    conn.executemany('''INSERT INTO orders (id, product_id, user_id, buyer_name, email, phone, telegram_username,
+                        payment_method, payment_proof_path, transaction_id, status, created_at, confirmed_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', orders)
+
+    # Mark a key as used for every confirmed order of a key product
+    conn.execute('''UPDATE product_keys SET is_used = TRUE, used_by_order_id = (
+                        SELECT MIN(o.id) FROM orders o
+                        WHERE o.product_id = product_keys.product_id AND o.status = 'confirmed')
+                    WHERE id IN (SELECT MIN(id) FROM product_keys GROUP BY product_id)
+                      AND EXISTS (SELECT 1 FROM orders o
+                                  WHERE o.product_id = product_keys.product_id AND o.status = 'confirmed')''')
+    conn.execute('''UPDATE products SET stock_count = (
+                        SELECT COUNT(*) FROM product_keys k WHERE k.product_id = products.id AND k.is_used = FALSE)
+                    WHERE type = 'key' ''')
+
+    reviews = [(rng.randint(1, n_users), rng.randint(1, n_products), rng.choices([1, 2, 3, 4, 5], [1, 1, 2, 4, 6])[0],
+                'Fast delivery, key worked.', timestamp(rng)) for _ in range(n_products)]
+    conn.executemany('''INSERT OR IGNORE INTO reviews (user_id, product_id, rating, comment, created_at)
+                        VALUES (?, ?, ?, ?, ?)''', reviews)
+    import app
+    app.rebuild_rating_summaries(conn)
+
+    conn.commit()
+    counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in ('products', 'product_keys', 'users', 'orders', 'reviews')}
+    conn.execute('ANALYZE')
+    conn.commit()
+    conn.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', choices=sorted(SIZES), default='10k', help='number of products')
+    parser.add_argument('--dir', required=True, help='directory for store.db (replaced if present)')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    counts = seed(args.dir, SIZES[args.size], args.seed)
+    summary = ', '.join(f'{count} {table}' for table, count in counts.items())
+    print(f'✅ Seeded {os.path.join(args.dir, "store.db")} in {time.perf_counter() - started:.1f}s: {summary}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+"""WSGI entry point for benchmarks: the real app with Resend and Telegram stubbed out.
+
+Outbound HTTP calls sleep for BENCH_UPSTREAM_LATENCY seconds (default 0.2) and return
+a canned success instead of leaving the machine, so runs are repeatable and never
+send real emails or messages.
+
+    gunicorn -c gunicorn_config.py --pythonpath .,benchmarks stub_app:app
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+import resend
+
+UPSTREAM_LATENCY = float(os.getenv('BENCH_UPSTREAM_LATENCY', 0.2))
+
+
+class _StubResponse:
+    status_code = 200
+    text = '{"ok": true}'
+    headers = {'content-type': 'application/json'}
+
+    def json(self):
+        return {'ok': True, 'id': 'stub'}
+
+
+def _stub_post(*args, **kwargs):
+    time.sleep(UPSTREAM_LATENCY)
+    return _StubResponse()
+
+
+def _stub_send(params):
+    time.sleep(UPSTREAM_LATENCY)
+    return {'id': 'stub'}
+
+
+def install_stubs():
+    """Replace the outbound HTTP clients used by the app"""
+    requests.post = _stub_post
+    requests.get = _stub_post
+    resend.Emails.send = staticmethod(_stub_send)
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'bench-token')
+    os.environ.setdefault('TELEGRAM_ADMIN_ID', '1')
+    os.environ.setdefault('RESEND_API_KEY', 're_bench')
+
+
+install_stubs()
+
+from app import app  # noqa: E402
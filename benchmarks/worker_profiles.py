@@ -0,0 +1,163 @@
+"""Load test comparing gunicorn worker profiles while an upstream call is slow.
+
+Each profile from gunicorn_config.py is started against benchmarks/stub_app.py in a
+scratch directory. Clients hit a mix of the homepage and the Telegram webhook (/start
+answers through the bot API, stubbed to take BENCH_UPSTREAM_LATENCY seconds), which is
+the situation where a sync worker stalls the whole store.
+
+    python benchmarks/worker_profiles.py --profiles sync,gthread --duration 10
+"""
+import argparse
+import http.client
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WEBHOOK_BODY = json.dumps({
+    'message': {'chat': {'id': 1}, 'text': '/start', 'from': {'first_name': 'Bench'}}
+})
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_ready(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/health')
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def start_server(profile, port, workdir, args):
+    env = dict(os.environ,
+               GUNICORN_PROFILE=profile,
+               BENCH_UPSTREAM_LATENCY=str(args.latency),
+               MAINTENANCE_INTERVAL='0')
+    if args.workers:
+        env['WEB_CONCURRENCY'] = str(args.workers)
+    if args.threads:
+        env['GUNICORN_THREADS'] = str(args.threads)
+    cmd = [sys.executable, '-m', 'gunicorn',
+           '-c', os.path.join(REPO_ROOT, 'gunicorn_config.py'),
+           '--bind', f'127.0.0.1:{port}',
+           '--chdir', workdir,
+           '--pythonpath', f"{REPO_ROOT},{os.path.join(REPO_ROOT, 'benchmarks')}",
+           '--log-level', 'warning',
+           'stub_app:app']
+    return subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run_load(port, duration, concurrency):
+    """Drive the server from `concurrency` client threads and return latencies in seconds"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.time() + duration
+
+    def client(n):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        i = n
+        while time.time() < stop_at:
+            started = time.perf_counter()
+            try:
+                if i % 2:
+                    conn.request('POST', '/webhook/telegram', body=WEBHOOK_BODY,
+                                 headers={'Content-Type': 'application/json'})
+                else:
+                    conn.request('GET', '/')
+                response = conn.getresponse()
+                response.read()
+                ok = response.status < 500
+            except OSError:
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+            i += 1
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors[0]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', default='sync,gthread,gevent')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.2, help='stubbed upstream latency (s)')
+    parser.add_argument('--workers', type=int, help='override WEB_CONCURRENCY for every profile')
+    parser.add_argument('--threads', type=int, help='override GUNICORN_THREADS')
+    args = parser.parse_args()
+
+    results = []
+    for profile in [p.strip() for p in args.profiles.split(',') if p.strip()]:
+        if profile == 'gevent':
+            try:
+                import gevent  # noqa: F401
+            except ImportError:
+                print('⏭️  Skipping gevent profile (gevent is not installed)')
+                continue
+
+        workdir = tempfile.mkdtemp(prefix=f'dzkeyz-bench-{profile}-')
+        port = free_port()
+        server = start_server(profile, port, workdir, args)
+        try:
+            if not wait_until_ready(port):
+                print(f'❌ {profile}: server did not start')
+                continue
+            latencies, errors = run_load(port, args.duration, args.concurrency)
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        rps = len(latencies) / args.duration
+        results.append((profile, rps, percentile(latencies, 50), percentile(latencies, 95), errors))
+        print(f'✅ {profile}: {rps:.1f} req/s')
+
+    if not results:
+        return 1
+
+    baseline = results[0][1] or 1
+    print()
+    print(f"{'profile':<10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}{'vs first':>10}")
+    for profile, rps, p50, p95, errors in results:
+        print(f'{profile:<10}{rps:>10.1f}{p50 * 1000:>10.1f}{p95 * 1000:>10.1f}{errors:>8}{rps / baseline:>9.1f}x')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,67 @@
 # Gunicorn configuration for Render deployment
-bind = "0.0.0.0:10000"
-workers = 1
-worker_class = "sync"
-worker_connections = 1000
+#
+# GUNICORN_PROFILE selects the worker model:
+#   gthread (default) - a few processes with a thread pool each; a slow Resend or
+#                       Telegram call only holds one thread instead of the whole worker
+#   gevent            - cooperative greenlets for very high connection counts
+#                       (needs `pip install gevent`)
+#   sync              - one request at a time per process (the old behaviour)
+#
+# uvicorn workers are not offered: they need an ASGI app and this is a WSGI (Flask) app.
+#
+# WEB_CONCURRENCY overrides the process count, GUNICORN_THREADS the threads per
+# gthread worker and GUNICORN_WORKER_CONNECTIONS the greenlets per gevent worker.
+import multiprocessing
+import os
+import tempfile
+
+profile = os.getenv('GUNICORN_PROFILE', 'gthread').strip().lower()
+cpu_count = multiprocessing.cpu_count()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+
+if profile == 'sync':
+    worker_class = "sync"
+    workers = int(os.getenv('WEB_CONCURRENCY', cpu_count * 2 + 1))
+elif profile == 'gevent':
+    worker_class = "gevent"
+    workers = int(os.getenv('WEB_CONCURRENCY', cpu_count))
+    worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+else:
+    worker_class = "gthread"
+    workers = int(os.getenv('WEB_CONCURRENCY', max(2, cpu_count)))
+    threads = int(os.getenv('GUNICORN_THREADS', 4))
+
 timeout = 30
-keepalive = 2
+graceful_timeout = 30
+keepalive = 5
 max_requests = 1000
 max_requests_jitter = 100
-preload_app = True
\ No newline at end of file
+
+# gevent has to patch the standard library before the app is imported, so the app
+# is loaded in each worker for that profile. The other profiles share it via fork.
+preload_app = profile != 'gevent'
+
+
+def when_ready(server):
+    # Start /metrics from zero: drop worker snapshots left over from the previous run
+    metrics_dir = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'dzkeyz-metrics'))
+    if os.path.isdir(metrics_dir):
+        for filename in os.listdir(metrics_dir):
+            if filename.endswith(('.json', '.tmp')):
+                os.remove(os.path.join(metrics_dir, filename))
+
+    # With a preloaded app, create/migrate the schema and warm the in-memory caches (landing
+    # pages, bundles, branding) once in the master so the forked workers start with them.
+    # Otherwise each worker does it in post_worker_init.
+    if preload_app:
+        import app
+        app.ensure_db()
+        app.warm_caches()
+
+
+def post_worker_init(worker):
+    if not preload_app:
+        import app
+        app.ensure_db()
+        app.warm_caches()